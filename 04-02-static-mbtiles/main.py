@@ -1,43 +1,141 @@
-from fastapi import FastAPI, Response
+from typing import Optional
+
+from fastapi import FastAPI, Request, Response
 from fastapi.staticfiles import StaticFiles
-from pymbtiles import MBtiles
+
+from caching import cache_headers, etag_matches, not_modified
+from encoding import encoding_headers, negotiate, transcode, variant_etag
+from model import TileBatch
+from tilesource import MBTilesSource, pack_tiles
 
 app = FastAPI()
 
+# バッチ取得で一度に要求できるタイル数の上限
+MAX_BATCH_TILES = 256
+
+# MBTilesは起動時に一度だけ開き、リクエスト間で使い回す
+# max_age: Cache-Controlでブラウザ・CDNにキャッシュさせる秒数
+vector_source = MBTilesSource("vector.mbtiles", max_age=3600)
+raster_source = MBTilesSource("raster.mbtiles", max_age=86400)
+
 
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
 
-@app.get("/vector/{z}/{x}/{y}.pbf")
-def vectortile(z: int, x: int, y: int):
-    # xyz -> tms
-    y = 2**z - y - 1
-    with MBtiles("vector.mbtiles") as src:
-        tile_data = src.read_tile(z=z, x=x, y=y)
-    if tile_data is None:
+def read_tile(
+    source: MBTilesSource,
+    request: Request,
+    z: int,
+    x: int,
+    y: int,
+    stored: Optional[str] = None,
+    target: Optional[str] = None,
+):
+    """
+    タイルデータとETagを返す。If-None-Matchが一致する場合は304のレスポンスを返す
+
+    stored, targetは格納されているエンコーディングと返すエンコーディング。
+    ETagはエンコーディングごとに別の値になる。
+    """
+    # エンコーディングを変換しうる場合は、304にも200と同じVaryを付ける
+    headers = {"vary": "Accept-Encoding"} if stored is not None else None
+
+    # タイルデータを読まずにETagが分かる場合は、一致すれば304を返す
+    etag = source.read_etag(z, x, y)
+    if etag is not None:
+        etag = variant_etag(etag, stored, target)
+        if etag_matches(request, etag):
+            return not_modified(etag, source.max_age, headers)
+
+    # xyz -> tmsの変換はタイルソース内で行う
+    tile = source.read_tile_with_etag(z=z, x=x, y=y)
+    if tile is None:
         return Response(status_code=404)
+    tile_data, etag = tile
+    etag = variant_etag(etag, stored, target)
+    if etag_matches(request, etag):
+        return not_modified(etag, source.max_age, headers)
+    return tile_data, etag
+
+
+@app.get("/vector/{z}/{x}/{y}.pbf")
+def vectortile(z: int, x: int, y: int, request: Request):
+    # 通常、MBTilesにはgzip圧縮されたデータを格納する。
+    # クライアントが対応していればgzipのまま返し、
+    # brotliなどを優先する場合や圧縮に未対応の場合は変換して返す。
+    encoding = negotiate(request.headers.get("accept-encoding"))
+    tile = read_tile(vector_source, request, z, x, y, "gzip", encoding)
+    if isinstance(tile, Response):
+        return tile
+    tile_data, etag = tile
 
     return Response(
-        content=tile_data,
+        content=transcode(tile_data, "gzip", encoding, etag),
         media_type="application/vnd.mapbox-vector-tile",
-        headers={"content-encoding": "gzip"},
+        headers={
+            **encoding_headers(encoding),
+            **cache_headers(etag, vector_source.max_age),
+        },
     )
     # content-encodingを指定する
-    # 通常、MBTilesにはgzip圧縮されたデータを格納する。
-    # ただし、クライアントはgzipされていないProtocol Buffersを期待している。
+    # クライアントはgzipされていないProtocol Buffersを期待しているため、
+    # 圧縮形式をcontent-encodingで伝え、ブラウザに展開させる。
 
 
 @app.get("/raster/{z}/{x}/{y}.png")
-def rastertile(z: int, x: int, y: int):
-    # xyz -> tms
-    y = 2**z - y - 1
-    with MBtiles("raster.mbtiles") as src:
-        tile_data = src.read_tile(z=z, x=x, y=y)
-    if tile_data is None:
-        return Response(status_code=404)
-    return Response(content=tile_data, media_type="image/png")
+def rastertile(z: int, x: int, y: int, request: Request):
+    tile = read_tile(raster_source, request, z, x, y)
+    if isinstance(tile, Response):
+        return tile
+    tile_data, etag = tile
+    return Response(
+        content=tile_data,
+        media_type="image/png",
+        headers=cache_headers(etag, raster_source.max_age),
+    )
+
+
+def read_batch(source: MBTilesSource, batch: TileBatch) -> Response:
+    """
+    複数のタイルをまとめて読み込み、1つのバイナリとして返す
+    """
+    tiles = list(batch.tiles)
+    if batch.range is not None:
+        r = batch.range
+        count = (r.maxx - r.minx + 1) * (r.maxy - r.miny + 1)
+        if count > MAX_BATCH_TILES:
+            return Response(status_code=400)
+        tiles += [
+            (r.z, x, y)
+            for x in range(r.minx, r.maxx + 1)
+            for y in range(r.miny, r.maxy + 1)
+        ]
+    if len(tiles) == 0 or len(tiles) > MAX_BATCH_TILES:
+        return Response(status_code=400)
+    for z, x, y in tiles:
+        if not (0 <= z <= 30 and 0 <= x < 2**z and 0 <= y < 2**z):
+            return Response(status_code=400)
+
+    body = pack_tiles(source.read_tiles(tiles))
+    return Response(content=body, media_type="application/octet-stream")
+
+
+@app.post("/vector/batch")
+def vectortile_batch(batch: TileBatch):
+    """
+    ベクトルタイルをまとめて返す。各タイルはMBTilesに格納されたgzip圧縮のまま
+    """
+    return read_batch(vector_source, batch)
+
+
+@app.post("/raster/batch")
+def rastertile_batch(batch: TileBatch):
+    """
+    ラスタータイルをまとめて返す
+    """
+    return read_batch(raster_source, batch)
 
 
 app.mount("/", StaticFiles(directory="static"), name="static")
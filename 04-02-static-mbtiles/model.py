@@ -0,0 +1,17 @@
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class TileRange(BaseModel):
+    z: int
+    minx: int
+    miny: int
+    maxx: int
+    maxy: int
+
+
+class TileBatch(BaseModel):
+    # [[z, x, y], ...]の形式でタイルを列挙するか、rangeで範囲を指定する
+    tiles: list[tuple[int, int, int]] = []
+    range: Optional[TileRange] = None
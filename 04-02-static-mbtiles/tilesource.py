@@ -0,0 +1,241 @@
+import math
+import sqlite3
+import struct
+import threading
+from pathlib import Path
+from typing import Optional
+
+from caching import LRUCache, content_etag
+
+# Webメルカトルで表現できる緯度の上限
+MAX_LATITUDE = 85.0511287798066
+# 1回のクエリでまとめて読み込むタイルの数
+# SQLiteのパラメータ数の上限（SQLITE_MAX_VARIABLE_NUMBER、古いバージョンでは999）に収める
+READ_TILES_CHUNK = 400
+
+
+def xyz_to_tms(z: int, y: int) -> int:
+    """
+    XYZ形式のy座標をTMS形式に変換する（TMS -> XYZも同じ式）
+    """
+    return 2**z - y - 1
+
+
+def pack_tiles(tiles: dict[tuple[int, int, int], Optional[bytes]]) -> bytes:
+    """
+    複数のタイルを1つのバイナリにまとめる
+
+    先頭にタイル数(uint32)、続いてタイルごとに
+    z(uint8), x(uint32), y(uint32), status(uint8), length(uint32), data
+    を並べる（いずれもビッグエンディアン）。statusは0が成功、1がタイルなし。
+    """
+    chunks = [struct.pack("!I", len(tiles))]
+    for (z, x, y), tile_data in tiles.items():
+        if tile_data is None:
+            chunks.append(struct.pack("!BIIBI", z, x, y, 1, 0))
+        else:
+            chunks.append(struct.pack("!BIIBI", z, x, y, 0, len(tile_data)))
+            chunks.append(tile_data)
+    return b"".join(chunks)
+
+
+def lonlat_to_tile(lon: float, lat: float, z: int) -> tuple[int, int]:
+    """
+    経緯度を含むタイルのx, y（XYZ形式）を返す
+    """
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    n = 2**z
+    x = int((lon + 180.0) / 360.0 * n)
+    lat_rad = math.radians(lat)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    # 経度180度・緯度-85度ちょうどの場合に範囲外とならないようにする
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+class MBTilesSource:
+    """
+    MBTilesファイルを読み取り専用で開いておくタイルソース
+
+    アプリケーションの起動時に一度だけ作成し、リクエスト間で使い回す。
+    SQLiteのコネクションはスレッドごとに作成・保持する。
+    max_ageはレスポンスのCache-Controlに使う秒数。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        mmap_size: int = 256 * 1024 * 1024,
+        max_age: int = 3600,
+        etag_cache_size: int = 100000,
+    ):
+        self.path = Path(path).resolve()
+        self.mmap_size = mmap_size
+        self.max_age = max_age
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+        # metadataテーブルは起動時に一度だけ読み込む
+        self.metadata = self._read_metadata()
+        self.format = self.metadata.get("format")
+        self.minzoom = int(self.metadata.get("minzoom", 0))
+        self.maxzoom = int(self.metadata.get("maxzoom", 22))
+        if "bounds" in self.metadata:
+            self.bounds = tuple(map(float, self.metadata["bounds"].split(",")))
+        else:
+            self.bounds = (-180.0, -MAX_LATITUDE, 180.0, MAX_LATITUDE)
+
+        # map/imagesテーブルを持つ（重複排除された）MBTilesでは、tile_idをETagに使える
+        tables = self.connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('map', 'images')"
+        ).fetchall()
+        self.deduplicated = len(tables) == 2
+        # 重複排除されていない場合は、タイルの内容から計算したETagをキャッシュする
+        self._etags = LRUCache(maxsize=etag_cache_size)
+
+    def _connect(self) -> sqlite3.Connection:
+        # mode=ro: 読み取り専用で開く
+        # immutable=1: ファイルが変更されない前提で、ロックや変更検知を省略する
+        conn = sqlite3.connect(
+            f"{self.path.as_uri()}?mode=ro&immutable=1",
+            uri=True,
+            check_same_thread=False,
+        )
+        # ファイルをメモリマップしてページの読み込みを高速化する
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        return conn
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        呼び出し元のスレッド専用のコネクションを返す
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _read_metadata(self) -> dict[str, str]:
+        rows = self.connection.execute("SELECT name, value FROM metadata").fetchall()
+        return {name: value for name, value in rows}
+
+    def tile_range(self, z: int) -> tuple[int, int, int, int]:
+        """
+        ズームレベルzでboundsに含まれるタイルの範囲（XYZ形式のminx, miny, maxx, maxy）
+        """
+        west, south, east, north = self.bounds
+        minx, miny = lonlat_to_tile(west, north, z)
+        maxx, maxy = lonlat_to_tile(east, south, z)
+        return minx, miny, maxx, maxy
+
+    def contains(self, z: int, x: int, y: int) -> bool:
+        """
+        タイルがズーム範囲・boundsに含まれるか（DBへ問い合わせずに判定する）
+        """
+        if z < self.minzoom or z > self.maxzoom:
+            return False
+        minx, miny, maxx, maxy = self.tile_range(z)
+        return minx <= x <= maxx and miny <= y <= maxy
+
+    def read_tile(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """
+        XYZ形式のタイル座標を受け取り、タイルデータを返す。存在しなければNone
+        """
+        if not self.contains(z, x, y):
+            return None
+        row = self.connection.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, xyz_to_tms(z, y)),
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def read_etag(self, z: int, x: int, y: int) -> Optional[str]:
+        """
+        タイルデータを読まずに分かるETagを返す。分からなければNone
+        """
+        if not self.contains(z, x, y):
+            return None
+        if not self.deduplicated:
+            return self._etags.get((z, x, y))
+        # mapテーブルのインデックスだけで完結し、imagesテーブルは読まない
+        row = self.connection.execute(
+            "SELECT tile_id FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, xyz_to_tms(z, y)),
+        ).fetchone()
+        if row is None:
+            return None
+        return f'"{row[0]}"'
+
+    def read_tile_with_etag(
+        self, z: int, x: int, y: int
+    ) -> Optional[tuple[bytes, str]]:
+        """
+        タイルデータとETagの組を返す。存在しなければNone
+        """
+        if not self.contains(z, x, y):
+            return None
+        if self.deduplicated:
+            row = self.connection.execute(
+                """SELECT map.tile_id, images.tile_data FROM map
+                JOIN images ON images.tile_id = map.tile_id
+                WHERE map.zoom_level = ? AND map.tile_column = ? AND map.tile_row = ?""",
+                (z, x, xyz_to_tms(z, y)),
+            ).fetchone()
+            if row is None:
+                return None
+            return row[1], f'"{row[0]}"'
+
+        tile_data = self.read_tile(z, x, y)
+        if tile_data is None:
+            return None
+        etag = content_etag(tile_data)
+        self._etags.put((z, x, y), etag)
+        return tile_data, etag
+
+    def read_tiles(
+        self, tiles: list[tuple[int, int, int]]
+    ) -> dict[tuple[int, int, int], Optional[bytes]]:
+        """
+        複数のタイル（XYZ形式）をまとめて読み込む。存在しないタイルの値はNone
+
+        ズームレベルごとに、要求されたタイルだけをまとめて1回のクエリで取得する。
+        """
+        result: dict[tuple[int, int, int], Optional[bytes]] = {
+            tile: None for tile in tiles
+        }
+        by_zoom: dict[int, set[tuple[int, int]]] = {}
+        for z, x, y in result:
+            if self.contains(z, x, y):
+                by_zoom.setdefault(z, set()).add((x, xyz_to_tms(z, y)))
+
+        for z, columns_rows in by_zoom.items():
+            columns_rows = sorted(columns_rows)
+            for i in range(0, len(columns_rows), READ_TILES_CHUNK):
+                chunk = columns_rows[i : i + READ_TILES_CHUNK]
+                values = ", ".join(["(?, ?)"] * len(chunk))
+                # 要求されたタイルごとに(zoom_level, tile_column, tile_row)のインデックスで引く
+                # 囲む範囲で検索すると、離れたタイルの間のタイルまですべて読んでしまう
+                cur = self.connection.execute(
+                    f"""WITH wanted (tile_column, tile_row) AS (VALUES {values})
+                    SELECT tiles.tile_column, tiles.tile_row, tiles.tile_data
+                    FROM wanted CROSS JOIN tiles
+                    WHERE tiles.zoom_level = ?
+                    AND tiles.tile_column = wanted.tile_column
+                    AND tiles.tile_row = wanted.tile_row""",
+                    (*(v for column_row in chunk for v in column_row), z),
+                )
+                for x, row, tile_data in cur:
+                    result[(z, x, xyz_to_tms(z, row))] = tile_data
+        return result
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
@@ -0,0 +1,83 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from fastapi import Request, Response
+
+
+class LRUCache:
+    """
+    要素数の上限を持つスレッドセーフなLRUキャッシュ
+
+    maxbytesを指定すると、putで渡したsizeの合計もその値以下に保つ。
+    """
+
+    def __init__(self, maxsize: int = 10000, maxbytes: Optional[int] = None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self._data: OrderedDict = OrderedDict()
+        self._sizes: dict = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key: Hashable, value: Any, size: int = 0):
+        with self._lock:
+            self.nbytes += size - self._sizes.get(key, 0)
+            self._data[key] = value
+            self._sizes[key] = size
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize or (
+                self.maxbytes is not None and self.nbytes > self.maxbytes
+            ):
+                evicted, _ = self._data.popitem(last=False)
+                self.nbytes -= self._sizes.pop(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+
+
+def content_etag(data: bytes) -> str:
+    """
+    タイルの内容から強いETagを計算する
+    """
+    return '"' + hashlib.blake2b(data, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: Optional[str]) -> bool:
+    """
+    リクエストのIf-None-MatchがETagと一致するか
+    """
+    header = request.headers.get("if-none-match")
+    if header is None or etag is None:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in [tag.strip().removeprefix("W/") for tag in header.split(",")]
+
+
+def cache_headers(etag: str, max_age: int) -> dict[str, str]:
+    return {"etag": etag, "cache-control": f"public, max-age={max_age}"}
+
+
+def not_modified(
+    etag: str, max_age: int, headers: Optional[dict[str, str]] = None
+) -> Response:
+    """
+    304 Not Modifiedのレスポンス（ボディなし）
+
+    headersには、200のレスポンスと同じVaryなどを渡す。
+    """
+    return Response(
+        status_code=304, headers={**(headers or {}), **cache_headers(etag, max_age)}
+    )
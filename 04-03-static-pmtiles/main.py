@@ -1,8 +1,52 @@
-from fastapi import FastAPI, Response
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import httpx
+from fastapi import FastAPI, Request, Response
 from fastapi.staticfiles import StaticFiles
-from aiopmtiles import Reader
 
-app = FastAPI()
+from caching import cache_headers, etag_matches, not_modified
+from encoding import encoding_headers, negotiate, transcode, variant_etag
+from pmtiles_source import ArchiveChanged, PMTilesSource
+
+# レイヤーごとの設定
+# url: PMTilesのURL。同じホストにファイルがある場合はfile://で指定すると、
+#      Webサーバーを経由せずにファイルをメモリマップして読む
+#      （例: "file:///app/pmtiles/vector.pmtiles"）
+# max_age: Cache-Controlでキャッシュさせる秒数
+# leaf_cache_bytes: リーフディレクトリのキャッシュに使うメモリの上限
+LAYERS = {
+    "vector": {
+        "url": "http://fileserver/vector.pmtiles",
+        "max_age": 3600,
+        "leaf_cache_bytes": 64 * 1024 * 1024,
+    },
+    "raster": {
+        "url": "http://fileserver/raster.pmtiles",
+        "max_age": 86400,
+        "leaf_cache_bytes": 16 * 1024 * 1024,
+    },
+}
+
+# 起動時に作成したタイルソース
+sources: dict[str, PMTilesSource] = {}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # すべてのタイルソースで1つのコネクションプールを共有し、keep-aliveで使い回す
+    limits = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+    async with httpx.AsyncClient(limits=limits) as client:
+        for name, layer in LAYERS.items():
+            sources[name] = PMTilesSource(client=client, **layer)
+        # ヘッダーとルートディレクトリは起動時に一度だけ読み込む
+        await asyncio.gather(*(source.open() for source in sources.values()))
+        yield
+        sources.clear()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/health")
@@ -10,28 +54,71 @@ def health():
     return {"status": "ok"}
 
 
-@app.get("/vector/{z}/{x}/{y}.pbf")
-async def vectortile(z: int, x: int, y: int):
-    async with Reader("http://fileserver/vector.pmtiles") as pmtiles:
-        tile_data = await pmtiles.get_tile(z, x, y)
+async def read_tile(
+    source: PMTilesSource,
+    request: Request,
+    z: int,
+    x: int,
+    y: int,
+    stored: Optional[str] = None,
+    target: Optional[str] = None,
+):
+    """
+    タイルデータとETagを返す。If-None-Matchが一致する場合は304のレスポンスを返す
 
-    if tile_data is None:
-        return Response(status_code=404)
+    stored, targetは格納されているエンコーディングと返すエンコーディング。
+    ETagはエンコーディングごとに別の値になる。
+    """
+    # エンコーディングを変換しうる場合は、304にも200と同じVaryを付ける
+    headers = {"vary": "Accept-Encoding"} if stored is not None else None
+    for _ in range(2):
+        # 途中で読み直されても、同じアーカイブのヘッダーとディレクトリを使う
+        archive = source.archive
+        try:
+            # ETagはディレクトリだけで決まるため、タイルデータを取得せずに304を返せる
+            entry = await source.get_entry(z, x, y, archive)
+            if entry is None:
+                return Response(status_code=404)
+            etag = variant_etag(source.entry_etag(entry, archive), stored, target)
+            if etag_matches(request, etag):
+                return not_modified(etag, source.max_age, headers)
+            return await source.read_entry(entry, archive), etag
+        except ArchiveChanged:
+            # アーカイブが更新されていたら、ヘッダーを読み直してやり直す
+            await source.reload(archive)
+    return Response(status_code=503)
+
+
+@app.get("/vector/{z}/{x}/{y}.pbf")
+async def vectortile(z: int, x: int, y: int, request: Request):
+    # PMTilesにはgzip圧縮されたベクトルタイルが格納されている
+    # クライアントが対応していればgzipのまま返し、そうでなければ変換して返す
+    source = sources["vector"]
+    encoding = negotiate(request.headers.get("accept-encoding"))
+    tile = await read_tile(source, request, z, x, y, "gzip", encoding)
+    if isinstance(tile, Response):
+        return tile
+    tile_data, etag = tile
 
     return Response(
-        content=tile_data,
+        content=transcode(tile_data, "gzip", encoding, etag),
         media_type="application/vnd.mapbox-vector-tile",
-        headers={"content-encoding": "gzip"},
+        headers={**encoding_headers(encoding), **cache_headers(etag, source.max_age)},
     )
 
 
 @app.get("/raster/{z}/{x}/{y}.png")
-async def rastertile(z: int, x: int, y: int):
-    async with Reader("http://fileserver/raster.pmtiles") as pmtiles:
-        tile_data = await pmtiles.get_tile(z, x, y)
-    if tile_data is None:
-        return Response(status_code=404)
-    return Response(content=tile_data, media_type="image/png")
+async def rastertile(z: int, x: int, y: int, request: Request):
+    source = sources["raster"]
+    tile = await read_tile(source, request, z, x, y)
+    if isinstance(tile, Response):
+        return tile
+    tile_data, etag = tile
+    return Response(
+        content=tile_data,
+        media_type="image/png",
+        headers=cache_headers(etag, source.max_age),
+    )
 
 
 app.mount("/", StaticFiles(directory="static"), name="static")
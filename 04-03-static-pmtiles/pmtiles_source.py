@@ -0,0 +1,362 @@
+import asyncio
+import mmap
+import os
+from functools import partial
+from typing import Awaitable, Callable, Optional, Union
+from urllib.parse import unquote, urlparse
+
+import httpx
+from pmtiles.tile import (
+    Entry,
+    deserialize_directory,
+    deserialize_header,
+    find_tile,
+    zxy_to_tileid,
+)
+
+from caching import LRUCache, content_etag
+
+# ヘッダー(127バイト)とルートディレクトリは、仕様上先頭16KiB以内に収まる
+HEADER_FETCH_LENGTH = 16384
+# ルートディレクトリからリーフディレクトリをたどる最大の深さ
+MAX_DIRECTORY_DEPTH = 4
+# デシリアライズしたディレクトリの1エントリあたりのメモリ使用量の目安（バイト）
+ENTRY_SIZE = 200
+
+
+class ArchiveChanged(Exception):
+    """
+    アーカイブが更新され、読み込み済みのヘッダー・ディレクトリが使えなくなった
+    """
+
+
+class RangeCoalescer:
+    """
+    同時に要求されたバイト範囲の読み込みをまとめて、1回のRangeリクエストにする
+
+    delay秒の間に集まった要求を位置順に並べ、間隔がmax_gap以下で
+    合計の長さがmax_length以下のものを1つの範囲にまとめて取得し、切り分けて返す。
+    Hilbert順のアーカイブでは近くのタイルが近くに格納されているため、
+    地図の表示時に同時に要求されるタイルの多くがまとまる。
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[int, int], Awaitable[bytes]],
+        max_gap: int = 64 * 1024,
+        max_length: int = 4 * 1024 * 1024,
+        delay: float = 0.002,
+    ):
+        self._fetch = fetch
+        self.max_gap = max_gap
+        self.max_length = max_length
+        self.delay = delay
+        self._pending: list[tuple[int, int, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def read(self, offset: int, length: int) -> bytes:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((offset, length, future))
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.delay, self._flush)
+        return await future
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        self._flush_handle = None
+
+        # 位置順に並べ、近い範囲をまとめる
+        groups: list[list] = []
+        for offset, length, future in sorted(pending, key=lambda p: p[0]):
+            end = offset + length
+            if groups:
+                group = groups[-1]
+                start, group_end, items = group
+                if (
+                    offset <= group_end + self.max_gap
+                    and max(group_end, end) - start <= self.max_length
+                ):
+                    group[1] = max(group_end, end)
+                    items.append((offset, length, future))
+                    continue
+            groups.append([offset, end, [(offset, length, future)]])
+
+        for start, end, items in groups:
+            task = asyncio.create_task(self._run(start, end, items))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, start: int, end: int, items: list):
+        try:
+            data = await self._fetch(start, end - start)
+        except Exception as e:
+            for _, _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for offset, length, future in items:
+            if not future.done():
+                future.set_result(data[offset - start : offset - start + length])
+
+
+class HTTPBackend:
+    """
+    HTTPのRangeリクエストでアーカイブを読むバックエンド
+    """
+
+    def __init__(self, url: str, client: httpx.AsyncClient):
+        self.url = url
+        self.client = client
+        self.version: Optional[str] = None
+        # 同時に発生したRangeリクエストをまとめる
+        self._coalescer = RangeCoalescer(partial(self._fetch, version=None))
+
+    async def open(self) -> tuple[bytes, Optional[str]]:
+        """
+        アーカイブの先頭と、バージョン（ETag）を返す。useを呼ぶまでは切り替えない
+        """
+        res = await self.client.get(
+            self.url, headers={"range": f"bytes=0-{HEADER_FETCH_LENGTH - 1}"}
+        )
+        res.raise_for_status()
+        return res.content, res.headers.get("etag")
+
+    def use(self, version: Optional[str]):
+        """
+        openで読んだバージョンのアーカイブに切り替える
+        """
+        self.version = version
+        self._coalescer = RangeCoalescer(partial(self._fetch, version=version))
+
+    async def _fetch(self, offset: int, length: int, version: Optional[str]) -> bytes:
+        headers = {"range": f"bytes={offset}-{offset + length - 1}"}
+        # アーカイブが読み込み時から変わっていれば、サーバーは412を返す
+        if version is not None:
+            headers["if-match"] = version
+        res = await self.client.get(self.url, headers=headers)
+        if res.status_code == 412:
+            raise ArchiveChanged(self.url)
+        res.raise_for_status()
+        if res.status_code == 200:
+            # Rangeに対応していないサーバーはファイル全体を返す
+            return res.content[offset : offset + length]
+        return res.content
+
+    async def read(self, offset: int, length: int, version: Optional[str]) -> bytes:
+        if version != self.version:
+            # 切り替え前後のアーカイブは、まとめずにそのバージョンで読む
+            return await self._fetch(offset, length, version)
+        return await self._coalescer.read(offset, length)
+
+
+class FileBackend:
+    """
+    ローカルのファイルをメモリマップして読むバックエンド
+
+    readはファイルの内容をコピーせずにmemoryviewとして返す。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.version: Optional[str] = None
+        self._mmap: Optional[mmap.mmap] = None
+        self._view: Optional[memoryview] = None
+        # openで開き、まだuseで切り替えていないファイル
+        self._opened: Optional[tuple[mmap.mmap, memoryview, str]] = None
+
+    @staticmethod
+    def _stat_version(stat: os.stat_result) -> str:
+        return f"{stat.st_ino}-{stat.st_size}-{stat.st_mtime_ns}"
+
+    async def open(self) -> tuple[memoryview, str]:
+        """
+        ファイルをメモリマップし、内容全体とバージョンを返す。useを呼ぶまでは切り替えない
+        """
+        with open(self.path, "rb") as f:
+            # mmapはファイル記述子を複製して持つため、ファイルはすぐに閉じてよい
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            version = self._stat_version(os.fstat(f.fileno()))
+        view = memoryview(mapped)
+        self._opened = (mapped, view, version)
+        return view, version
+
+    def use(self, version: str):
+        """
+        openで開いたファイルに切り替え、それまでのファイルを閉じる
+        """
+        mapped, view, opened_version = self._opened
+        assert opened_version == version
+        old_mmap, old_view = self._mmap, self._view
+        self._mmap, self._view, self.version = mapped, view, version
+        self._opened = None
+        if old_mmap is not None:
+            old_view.release()
+            try:
+                old_mmap.close()
+            except BufferError:
+                # 送信中のレスポンスが古い内容を参照している。参照がなくなれば解放される
+                pass
+
+    async def read(self, offset: int, length: int, version: str) -> memoryview:
+        # 切り替え前のアーカイブのエントリや、ファイルが置き換えられていれば読み直させる
+        if version != self.version or (
+            self._stat_version(os.stat(self.path)) != version
+        ):
+            raise ArchiveChanged(self.path)
+        return self._view[offset : offset + length]
+
+
+class Archive:
+    """
+    読み込んだアーカイブのヘッダー、ルートディレクトリとバージョン
+
+    アーカイブが更新されたら、新しいArchiveを作ってから1回の代入で置き換える。
+    リクエストの処理中ははじめに参照したArchiveを使い続け、ヘッダーとディレクトリを食い違わせない。
+    """
+
+    def __init__(
+        self, header: dict, root: list[Entry], version: Optional[str], fingerprint: str
+    ):
+        self.header = header
+        self.root = root
+        self.version = version
+        # ヘッダーとルートディレクトリのハッシュ。バージョン（ETag）がない場合に、ETagに含める
+        self.fingerprint = fingerprint
+
+
+class PMTilesSource:
+    """
+    PMTilesアーカイブを読むタイルソース
+
+    アプリケーションの起動時に一度だけ作成し、リクエスト間で使い回す。
+    urlがfile://で始まる場合はローカルのファイルをメモリマップして読み、
+    http(s)://の場合はclientのコネクションプールを共有してRangeリクエストで読む。
+    ヘッダーとルートディレクトリは最初に一度だけ読み込み、
+    リーフディレクトリはleaf_cache_bytesまでメモリにキャッシュする。
+    """
+
+    def __init__(
+        self,
+        url: str,
+        client: Optional[httpx.AsyncClient] = None,
+        max_age: int = 3600,
+        leaf_cache_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.url = url
+        self.max_age = max_age
+        parsed = urlparse(url)
+        if parsed.scheme == "file":
+            self.backend = FileBackend(unquote(parsed.path))
+        elif parsed.scheme in ("http", "https"):
+            self.backend = HTTPBackend(url, client)
+        else:
+            raise ValueError(f"対応していないURLです: {url}")
+        self.archive: Optional[Archive] = None
+        self._lock = asyncio.Lock()
+        self._leaves = LRUCache(maxsize=1000000, maxbytes=leaf_cache_bytes)
+
+    async def open(self):
+        """
+        ヘッダーとルートディレクトリを読み込む
+
+        読み込みの途中では、処理中のリクエストが使っているアーカイブを変えない。
+        """
+        data, version = await self.backend.open()
+        header_data = bytes(data[0:127])
+        header = deserialize_header(header_data)
+
+        root_offset = header["root_offset"]
+        root_length = header["root_length"]
+        if root_offset + root_length <= len(data):
+            root_data = data[root_offset : root_offset + root_length]
+        else:
+            root_data = await self.backend.read(root_offset, root_length, version)
+        root_data = bytes(root_data)
+        archive = Archive(
+            header,
+            deserialize_directory(root_data),
+            version,
+            content_etag(header_data + root_data),
+        )
+
+        # ここからはawaitを挟まずに切り替える
+        self.backend.use(version)
+        self.archive = archive
+        self._leaves.clear()
+
+    async def reload(self, archive: Archive):
+        """
+        アーカイブの更新を検知したときに、ヘッダーとルートディレクトリを読み直す
+
+        archiveには、更新を検知したリクエストが使っていたアーカイブを渡す。
+        """
+        async with self._lock:
+            # 他のリクエストがすでに読み直していれば何もしない
+            if self.archive is archive:
+                await self.open()
+
+    async def get_entry(
+        self, z: int, x: int, y: int, archive: Optional[Archive] = None
+    ) -> Optional[Entry]:
+        """
+        タイルのエントリ（タイルデータの位置と長さ）を返す。存在しなければNone
+
+        archiveを省略した場合は、現在のアーカイブから探す。
+        """
+        archive = archive or self.archive
+        header = archive.header
+        if z < header["min_zoom"] or z > header["max_zoom"]:
+            return None
+        # 範囲外のx, yはタイルIDに変換できない（zxy_to_tileidがValueErrorを送出する）
+        if not (0 <= x < 2**z and 0 <= y < 2**z):
+            return None
+
+        tile_id = zxy_to_tileid(z, x, y)
+        directory = archive.root
+        for _ in range(MAX_DIRECTORY_DEPTH):
+            entry = find_tile(directory, tile_id)
+            if entry is None:
+                return None
+            if entry.run_length > 0:
+                return entry
+            # run_lengthが0のエントリはリーフディレクトリを指す
+            directory = await self._read_leaf(archive, entry)
+        return None
+
+    async def _read_leaf(self, archive: Archive, entry: Entry) -> list[Entry]:
+        key = (archive.version, entry.offset, entry.length)
+        leaf = self._leaves.get(key)
+        if leaf is None:
+            data = await self.backend.read(
+                archive.header["leaf_directory_offset"] + entry.offset,
+                entry.length,
+                archive.version,
+            )
+            leaf = deserialize_directory(bytes(data))
+            self._leaves.put(key, leaf, size=len(leaf) * ENTRY_SIZE)
+        return leaf
+
+    def entry_etag(self, entry: Entry, archive: Optional[Archive] = None) -> str:
+        """
+        エントリのETag。重複排除されたタイルは同じ位置を指すため、内容が同じなら同じ値になる
+
+        アーカイブのバージョンがない（サーバーがETagを返さない）場合は、位置と長さが同じでも
+        アーカイブが作り直されていれば別の値になるよう、ヘッダーとルートディレクトリのハッシュを含める。
+        """
+        archive = archive or self.archive
+        version = archive.version
+        if version is None:
+            version = archive.fingerprint
+        return content_etag(f"{version}:{entry.offset}:{entry.length}".encode())
+
+    async def read_entry(
+        self, entry: Entry, archive: Optional[Archive] = None
+    ) -> Union[bytes, memoryview]:
+        archive = archive or self.archive
+        return await self.backend.read(
+            archive.header["tile_data_offset"] + entry.offset,
+            entry.length,
+            archive.version,
+        )
@@ -0,0 +1,458 @@
+"""
+タイルセットの形式を変換するスクリプト
+
+ディレクトリ形式（z/x/y.拡張子）、MBTiles、PMTilesを読み込み、MBTilesまたはPMTilesに書き出す。
+タイルの内容のハッシュをプロセスプールで計算し、内容が同じタイル（海域や空白のタイルなど）は1つにまとめる。
+PMTilesはタイルIDの順（Hilbert順）に書き出す。タイルは少しずつ読み込んで処理するため、
+タイル数が多くてもメモリ使用量はほぼ一定になる（PMTilesのディレクトリのエントリのみメモリに保持する）。
+
+使い方:
+    python scripts/pack.py ../04-01-static-directory/raster pmtiles/raster.pmtiles
+    python scripts/pack.py ../04-02-static-mbtiles/vector.mbtiles pmtiles/vector.pmtiles
+    python scripts/pack.py pmtiles/vector.pmtiles vector.mbtiles --workers 8
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import mmap
+import multiprocessing
+import multiprocessing.pool
+import os
+import shutil
+import sqlite3
+import tempfile
+from itertools import islice
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from pmtiles.tile import (
+    Compression,
+    Entry,
+    TileType,
+    deserialize_directory,
+    deserialize_header,
+    serialize_header,
+    tileid_to_zxy,
+    zxy_to_tileid,
+)
+from pmtiles.writer import optimize_directories
+
+GZIP_MAGIC = b"\x1f\x8b"
+# PMTilesのヘッダーとルートディレクトリを先頭16KiBに収める
+ROOT_DIRECTORY_LENGTH = 16384 - 127
+# 一度にプロセスプールへ渡すタイル数
+BATCH_SIZE = 4096
+
+TILE_TYPES = {
+    "pbf": TileType.MVT,
+    "png": TileType.PNG,
+    "jpg": TileType.JPEG,
+    "webp": TileType.WEBP,
+}
+
+Tile = tuple[int, int, int, bytes]
+
+
+def batched(iterable: Iterable, n: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, n)):
+        yield batch
+
+
+def read_directory(path: Path) -> tuple[dict, Iterator[Tile]]:
+    """
+    z/x/y.拡張子の形式で保存されたタイルを読み込む
+    """
+    metadata = {}
+    if (path / "metadata.json").exists():
+        metadata = json.loads((path / "metadata.json").read_text())
+
+    def tiles():
+        for z_dir in sorted(path.iterdir(), key=lambda p: p.name):
+            if not z_dir.name.isdigit():
+                continue
+            for x_dir in z_dir.iterdir():
+                for tile_path in x_dir.iterdir():
+                    yield (
+                        int(z_dir.name),
+                        int(x_dir.name),
+                        int(tile_path.stem),
+                        tile_path.read_bytes(),
+                    )
+
+    if "format" not in metadata:
+        # 最初のタイルの拡張子から形式を決める
+        first = next(iter(path.glob("*/*/*.*")), None)
+        if first is not None:
+            metadata["format"] = first.suffix[1:]
+    return metadata, tiles()
+
+
+def read_mbtiles(path: Path) -> tuple[dict, Iterator[Tile]]:
+    conn = sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True)
+    metadata = dict(conn.execute("SELECT name, value FROM metadata").fetchall())
+
+    def tiles():
+        cur = conn.execute(
+            "SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles"
+        )
+        for z, x, row, tile_data in cur:
+            # tms -> xyz
+            yield z, x, 2**z - row - 1, tile_data
+        conn.close()
+
+    return metadata, tiles()
+
+
+def read_pmtiles(path: Path) -> tuple[dict, Iterator[Tile]]:
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header = deserialize_header(data[0:127])
+
+    raw = data[
+        header["metadata_offset"] : header["metadata_offset"]
+        + header["metadata_length"]
+    ]
+    if header["internal_compression"] == Compression.GZIP:
+        raw = gzip.decompress(raw)
+    pmtiles_metadata = json.loads(raw) if raw else {}
+
+    # MBTilesのmetadataテーブルと同じ形式にそろえる
+    metadata = {
+        key: value if isinstance(value, str) else json.dumps(value)
+        for key, value in pmtiles_metadata.items()
+        if key != "vector_layers"
+    }
+    if "vector_layers" in pmtiles_metadata:
+        metadata["json"] = json.dumps(
+            {"vector_layers": pmtiles_metadata["vector_layers"]}
+        )
+    for name, tile_type in TILE_TYPES.items():
+        if header["tile_type"] == tile_type:
+            metadata["format"] = name
+    metadata["bounds"] = ",".join(
+        str(header[key] / 1e7)
+        for key in ("min_lon_e7", "min_lat_e7", "max_lon_e7", "max_lat_e7")
+    )
+
+    def traverse(offset: int, length: int) -> Iterator[Tile]:
+        for entry in deserialize_directory(data[offset : offset + length]):
+            if entry.run_length == 0:
+                yield from traverse(
+                    header["leaf_directory_offset"] + entry.offset, entry.length
+                )
+                continue
+            start = header["tile_data_offset"] + entry.offset
+            tile_data = data[start : start + entry.length]
+            for tile_id in range(entry.tile_id, entry.tile_id + entry.run_length):
+                z, x, y = tileid_to_zxy(tile_id)
+                yield z, x, y, tile_data
+
+    return metadata, traverse(header["root_offset"], header["root_length"])
+
+
+def open_source(path: Path) -> tuple[dict, Iterator[Tile]]:
+    if path.is_dir():
+        return read_directory(path)
+    if path.suffix == ".mbtiles":
+        return read_mbtiles(path)
+    if path.suffix == ".pmtiles":
+        return read_pmtiles(path)
+    raise ValueError(f"対応していない形式です: {path}")
+
+
+def prepare_tile(args: tuple[bytes, bool]) -> tuple[bytes, bytes | None]:
+    """
+    タイルのハッシュを計算する（ワーカープロセスで実行される）
+
+    ベクトルタイルは格納時の慣例に合わせてgzip圧縮し、圧縮した場合はそのデータも返す。
+    """
+    tile_data, compress = args
+    compressed = None
+    if compress and tile_data[:2] != GZIP_MAGIC:
+        compressed = tile_data = gzip.compress(tile_data, mtime=0)
+    return hashlib.blake2b(tile_data, digest_size=16).digest(), compressed
+
+
+def prepare_tiles(
+    tiles: Iterator[Tile], pool: multiprocessing.pool.Pool, compress: bool
+) -> Iterator[tuple[int, int, int, bytes, bytes]]:
+    """
+    タイルをバッチごとにプロセスプールでハッシュ化し、(z, x, y, ハッシュ, データ)を返す
+
+    次のバッチを読み込んでいる間に、前のバッチのハッシュを計算する。
+    """
+
+    def finish(batch, job):
+        for (z, x, y, tile_data), (digest, compressed) in zip(batch, job.get()):
+            yield z, x, y, digest, compressed or tile_data
+
+    pending = None
+    for batch in batched(tiles, BATCH_SIZE):
+        job = pool.map_async(
+            prepare_tile, [(tile[3], compress) for tile in batch], chunksize=256
+        )
+        if pending is not None:
+            yield from finish(*pending)
+        pending = (batch, job)
+    if pending is not None:
+        yield from finish(*pending)
+
+
+def parse_bounds(metadata: dict) -> list[float]:
+    if "bounds" in metadata:
+        return [float(v) for v in metadata["bounds"].split(",")]
+    return [-180.0, -85.0511287798066, 180.0, 85.0511287798066]
+
+
+def write_mbtiles(path: Path, metadata: dict, tiles: Iterator) -> dict:
+    """
+    重複排除したMBTiles（map/imagesテーブル）として書き出す
+    """
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        PRAGMA journal_mode = OFF;
+        PRAGMA synchronous = OFF;
+        CREATE TABLE metadata (name TEXT, value TEXT);
+        CREATE TABLE map (
+            zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT
+        );
+        CREATE TABLE images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+        CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, tile_row);
+        CREATE VIEW tiles AS
+            SELECT map.zoom_level AS zoom_level,
+                map.tile_column AS tile_column,
+                map.tile_row AS tile_row,
+                images.tile_data AS tile_data
+            FROM map JOIN images ON images.tile_id = map.tile_id;
+        """
+    )
+
+    stats = {"tiles": 0, "minzoom": None, "maxzoom": None}
+    # バッチごとにトランザクションをコミットする
+    for batch in batched(tiles, BATCH_SIZE):
+        conn.executemany(
+            "INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)",
+            [(digest.hex(), tile_data) for _, _, _, digest, tile_data in batch],
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?)",
+            [(z, x, 2**z - y - 1, digest.hex()) for z, x, y, digest, _ in batch],
+        )
+        conn.commit()
+        update_stats(stats, batch)
+
+    metadata = {
+        **metadata,
+        "minzoom": str(stats["minzoom"]),
+        "maxzoom": str(stats["maxzoom"]),
+    }
+    conn.executemany("INSERT INTO metadata VALUES (?, ?)", list(metadata.items()))
+    conn.commit()
+    stats["contents"] = conn.execute("SELECT count(*) FROM images").fetchone()[0]
+    conn.close()
+    return stats
+
+
+def write_pmtiles(path: Path, metadata: dict, tiles: Iterator) -> dict:
+    """
+    タイルIDの順にタイルデータを並べたPMTilesとして書き出す
+    """
+    with tempfile.TemporaryDirectory(dir=path.parent) as tmpdir:
+        tmpdir = Path(tmpdir)
+        # タイルIDとハッシュの対応は、メモリではなく一時的なSQLiteに保持する
+        index = sqlite3.connect(tmpdir / "index.db")
+        index.executescript(
+            """
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE tiles (tile_id INTEGER PRIMARY KEY, digest BLOB NOT NULL);
+            CREATE TABLE contents (
+                digest BLOB PRIMARY KEY,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                final_offset INTEGER
+            );
+            """
+        )
+
+        # 1パス目: 重複のないタイルデータを一時ファイルに書き出し、タイルIDとハッシュを記録する
+        stats = {"tiles": 0, "minzoom": None, "maxzoom": None}
+        with open(tmpdir / "staged.bin", "w+b") as staged:
+            for batch in batched(tiles, BATCH_SIZE):
+                for _, _, _, digest, tile_data in batch:
+                    exists = index.execute(
+                        "SELECT 1 FROM contents WHERE digest = ?", (digest,)
+                    ).fetchone()
+                    if exists is None:
+                        index.execute(
+                            "INSERT INTO contents (digest, offset, length) VALUES (?, ?, ?)",
+                            (digest, staged.tell(), len(tile_data)),
+                        )
+                        staged.write(tile_data)
+                index.executemany(
+                    "INSERT OR REPLACE INTO tiles VALUES (?, ?)",
+                    [(zxy_to_tileid(z, x, y), d) for z, x, y, d, _ in batch],
+                )
+                index.commit()
+                update_stats(stats, batch)
+
+            # 2パス目: タイルIDの順にタイルデータを並べ直し、ディレクトリのエントリを作る
+            entries: list[Entry] = []
+            contents = 0
+            lookup = index.cursor()
+            with open(tmpdir / "tiledata.bin", "w+b") as tile_data_file:
+                for tile_id, digest in index.execute(
+                    "SELECT tile_id, digest FROM tiles ORDER BY tile_id"
+                ):
+                    offset, length, final_offset = lookup.execute(
+                        "SELECT offset, length, final_offset FROM contents WHERE digest = ?",
+                        (digest,),
+                    ).fetchone()
+                    if final_offset is None:
+                        final_offset = tile_data_file.tell()
+                        staged.seek(offset)
+                        tile_data_file.write(staged.read(length))
+                        lookup.execute(
+                            "UPDATE contents SET final_offset = ? WHERE digest = ?",
+                            (final_offset, digest),
+                        )
+                        contents += 1
+
+                    last = entries[-1] if entries else None
+                    if (
+                        last is not None
+                        and last.tile_id + last.run_length == tile_id
+                        and last.offset == final_offset
+                    ):
+                        # 連続するタイルIDが同じ内容なら、1つのエントリにまとめる
+                        last.run_length += 1
+                    else:
+                        entries.append(Entry(tile_id, final_offset, length, 1))
+                index.close()
+
+                root_bytes, leaves_bytes, _ = optimize_directories(
+                    entries, ROOT_DIRECTORY_LENGTH
+                )
+                metadata_bytes = gzip.compress(
+                    json.dumps(pmtiles_metadata(metadata)).encode(), mtime=0
+                )
+                header = pmtiles_header(metadata, stats)
+                header.update(
+                    {
+                        "root_offset": 127,
+                        "root_length": len(root_bytes),
+                        "metadata_offset": 127 + len(root_bytes),
+                        "metadata_length": len(metadata_bytes),
+                        "leaf_directory_offset": 127
+                        + len(root_bytes)
+                        + len(metadata_bytes),
+                        "leaf_directory_length": len(leaves_bytes),
+                        "tile_data_offset": 127
+                        + len(root_bytes)
+                        + len(metadata_bytes)
+                        + len(leaves_bytes),
+                        "tile_data_length": tile_data_file.tell(),
+                        "addressed_tiles_count": stats["tiles"],
+                        "tile_entries_count": len(entries),
+                        "tile_contents_count": contents,
+                    }
+                )
+
+                tmp_path = tmpdir / path.name
+                with open(tmp_path, "wb") as out:
+                    out.write(serialize_header(header))
+                    out.write(root_bytes)
+                    out.write(metadata_bytes)
+                    out.write(leaves_bytes)
+                    tile_data_file.seek(0)
+                    shutil.copyfileobj(tile_data_file, out, 1024 * 1024)
+                os.replace(tmp_path, path)
+
+    stats["contents"] = contents
+    return stats
+
+
+def update_stats(stats: dict, batch: list):
+    zooms = [tile[0] for tile in batch]
+    if stats["minzoom"] is not None:
+        zooms += [stats["minzoom"], stats["maxzoom"]]
+    stats["tiles"] += len(batch)
+    stats["minzoom"] = min(zooms)
+    stats["maxzoom"] = max(zooms)
+
+
+def pmtiles_metadata(metadata: dict) -> dict:
+    """
+    MBTiles形式のmetadataを、PMTilesのJSONメタデータに変換する
+    """
+    result = {key: value for key, value in metadata.items() if key != "json"}
+    if "json" in metadata:
+        result.update(json.loads(metadata["json"]))
+    return result
+
+
+def pmtiles_header(metadata: dict, stats: dict) -> dict:
+    min_lon, min_lat, max_lon, max_lat = parse_bounds(metadata)
+    if "center" in metadata:
+        center_lon, center_lat, center_zoom = metadata["center"].split(",")
+    else:
+        center_lon = (min_lon + max_lon) / 2
+        center_lat = (min_lat + max_lat) / 2
+        center_zoom = stats["minzoom"]
+    tile_type = TILE_TYPES.get(metadata.get("format"), TileType.UNKNOWN)
+    return {
+        "clustered": True,
+        "internal_compression": Compression.GZIP,
+        "tile_compression": (
+            Compression.GZIP if tile_type == TileType.MVT else Compression.NONE
+        ),
+        "tile_type": tile_type,
+        "min_zoom": stats["minzoom"],
+        "max_zoom": stats["maxzoom"],
+        "min_lon_e7": int(min_lon * 1e7),
+        "min_lat_e7": int(min_lat * 1e7),
+        "max_lon_e7": int(max_lon * 1e7),
+        "max_lat_e7": int(max_lat * 1e7),
+        "center_zoom": int(center_zoom),
+        "center_lon_e7": int(float(center_lon) * 1e7),
+        "center_lat_e7": int(float(center_lat) * 1e7),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="タイルセットの形式を変換する")
+    parser.add_argument("src", type=Path, help="ディレクトリ、.mbtiles、.pmtiles")
+    parser.add_argument("dst", type=Path, help=".mbtilesまたは.pmtiles")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="ハッシュ計算のプロセス数"
+    )
+    args = parser.parse_args()
+
+    if args.dst.suffix == ".mbtiles":
+        write = write_mbtiles
+    elif args.dst.suffix == ".pmtiles":
+        write = write_pmtiles
+    else:
+        raise ValueError(f"対応していない形式です: {args.dst}")
+
+    # 同じディレクトリの一時ファイルに書き出し、最後に置き換える
+    # srcとdstが同じファイルでも読み込み中の内容を壊さず、途中で失敗してもdstは元のまま残る
+    tmp = args.dst.with_name(f".{args.dst.name}.{os.getpid()}.tmp")
+    try:
+        metadata, tiles = open_source(args.src)
+        with multiprocessing.Pool(args.workers) as pool:
+            prepared = prepare_tiles(tiles, pool, metadata.get("format") == "pbf")
+            stats = write(tmp, metadata, prepared)
+        os.replace(tmp, args.dst)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+    print(f"{stats['tiles']} tiles ({stats['contents']} unique) -> {args.dst}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import gzip
+from typing import Optional
+
+from caching import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# サーバー側で優先するエンコーディングの順（インストールされているものだけ）
+ENCODINGS = [
+    name for name, module in (("br", brotli), ("zstd", zstandard)) if module
+] + ["gzip"]
+
+# 変換後のタイルをキャッシュし、同じタイルを何度も圧縮しないようにする
+variants = LRUCache(maxsize=20000)
+
+
+def negotiate(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Accept-Encodingヘッダーからレスポンスのエンコーディングを選ぶ。Noneは無圧縮
+    """
+    if not accept_encoding:
+        return None
+
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+
+    best, best_weight = None, 0.0
+    for name in ENCODINGS:
+        weight = weights.get(name, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = name, weight
+    return best
+
+
+def compress(data: bytes, encoding: Optional[str]) -> bytes:
+    if encoding == "gzip":
+        return gzip.compress(data, mtime=0)
+    if encoding == "br":
+        return brotli.compress(data, quality=9)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return data
+
+
+def decompress(data: bytes, encoding: Optional[str]) -> bytes:
+    # gzipとして格納されていても、実際には無圧縮のタイルがありうる
+    if encoding == "gzip" and data[:2] == GZIP_MAGIC:
+        return gzip.decompress(data)
+    if encoding == "br":
+        return brotli.decompress(data)
+    if encoding == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+def variant_etag(etag: str, stored: Optional[str], target: Optional[str]) -> str:
+    """
+    エンコーディングを変換したレスポンスのETag（変換前とは別の値にする）
+    """
+    if stored == target:
+        return etag
+    return f'{etag[:-1]}-{target or "identity"}"'
+
+
+def transcode(
+    data: bytes, stored: Optional[str], target: Optional[str], key: str
+) -> bytes:
+    """
+    storedで圧縮されたデータをtargetのエンコーディングに変換する
+
+    keyには変換後のETagを渡し、変換結果をキャッシュするキーとして使う。
+    """
+    if stored == target:
+        return data
+    cached = variants.get(key)
+    if cached is not None:
+        return cached
+    encoded = compress(decompress(data, stored), target)
+    variants.put(key, encoded)
+    return encoded
+
+
+def encoding_headers(encoding: Optional[str]) -> dict[str, str]:
+    headers = {"vary": "Accept-Encoding"}
+    if encoding is not None:
+        headers["content-encoding"] = encoding
+    return headers
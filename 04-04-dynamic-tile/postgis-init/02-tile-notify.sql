@@ -0,0 +1,67 @@
+-- 地物が変更されたときに、変更前後の範囲をtile_changeチャンネルへ通知する
+-- APIはこの通知を受け取り、該当するタイルのキャッシュを破棄する
+CREATE OR REPLACE FUNCTION notify_tile_change() RETURNS trigger AS $$
+DECLARE
+  bboxes json[] := '{}';
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    bboxes := bboxes || json_build_array(
+      ST_XMin(OLD.geom), ST_YMin(OLD.geom), ST_XMax(OLD.geom), ST_YMax(OLD.geom)
+    );
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    bboxes := bboxes || json_build_array(
+      ST_XMin(NEW.geom), ST_YMin(NEW.geom), ST_XMax(NEW.geom), ST_YMax(NEW.geom)
+    );
+  END IF;
+  PERFORM pg_notify(
+    'tile_change',
+    json_build_object('layer', TG_ARGV[0], 'bboxes', array_to_json(bboxes))::text
+  );
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 変更を通知するテーブルの一覧（main.pyのLAYERSにテーブルを追加したら、ここにも追加する）
+CREATE TABLE IF NOT EXISTS tile_change_tables (name text PRIMARY KEY);
+INSERT INTO tile_change_tables VALUES ('school') ON CONFLICT DO NOTHING;
+
+-- tile_change_tablesのテーブルに、変更を通知するトリガーを作成する
+CREATE OR REPLACE FUNCTION create_tile_change_triggers(tables regclass[]) RETURNS void AS $$
+DECLARE
+  target record;
+BEGIN
+  FOR target IN
+    SELECT t.name, c.oid::regclass AS relation
+    FROM pg_class AS c JOIN tile_change_tables AS t ON t.name = c.relname
+    WHERE c.oid = ANY(tables) AND c.relkind = 'r'
+  LOOP
+    EXECUTE format(
+      'CREATE OR REPLACE TRIGGER %I AFTER INSERT OR UPDATE OR DELETE ON %s
+       FOR EACH ROW EXECUTE FUNCTION notify_tile_change(%L)',
+      target.name || '_tile_change', target.relation, target.name
+    );
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- schoolテーブルはデータの読み込み時（ogr2ogr）に作成されるため、ここではまだ存在しない
+-- テーブルが作成されたとき（作り直されたときも）に、イベントトリガーでトリガーを作成する
+-- APIの起動時にはDDLを実行しない
+CREATE OR REPLACE FUNCTION on_table_created() RETURNS event_trigger AS $$
+BEGIN
+  PERFORM create_tile_change_triggers(array(
+    SELECT objid::regclass FROM pg_event_trigger_ddl_commands()
+    WHERE object_type = 'table'
+  ));
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE EVENT TRIGGER tile_change_table_created ON ddl_command_end
+  WHEN TAG IN ('CREATE TABLE', 'CREATE TABLE AS', 'SELECT INTO')
+  EXECUTE FUNCTION on_table_created();
+
+-- すでに存在するテーブルにも作成する（既存のデータベースにこのファイルを流した場合）
+SELECT create_tile_change_triggers(array(
+  SELECT to_regclass(name) FROM tile_change_tables WHERE to_regclass(name) IS NOT NULL
+));
@@ -0,0 +1,92 @@
+from typing import Callable, Sequence
+
+from generalize import render_within_budget
+
+
+def quote_ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def tile_statements(
+    name: str, table: str, columns: Sequence[str] = (), layer: str = "vector"
+) -> dict[str, str]:
+    """
+    テーブルの点からタイルを生成するクエリ（プリペアドステートメント）
+
+    name_tileは点をそのまま、name_tile_clusteredはグリッドでまとめて描画する。
+    columnsはタイルに含める属性で、クラスターにはその中の1点の値を持たせる。
+    layerはタイル内のレイヤー名。
+    """
+    table = quote_ident(table)
+    layer = layer.replace("'", "''")
+    selected = "".join(f", {quote_ident(c)}" for c in columns)
+    representative = "".join(
+        f", (array_agg({quote_ident(c)}))[1] AS {quote_ident(c)}" for c in columns
+    )
+    return {
+        # やっていること
+        # 1: タイルの範囲（ウェブメルカトル）を経緯度へ変換
+        # 2: geomの空間インデックスを使って、タイルの範囲の地物を検索
+        #    （geomの側を変換すると、インデックスが使えず全件を変換することになる）
+        # 3: 検索された地物だけを経緯度からウェブメルカトルへ変換
+        # 4: MapboxVectorTile形式のバイナリに変換
+        # 5: 点が多すぎるタイルを検出するため、$4件までに制限して件数も返す
+        f"{name}_tile": f"""WITH mvtgeom AS (
+            SELECT ST_AsMVTGeom(ST_Transform(geom, 3857), ST_TileEnvelope($1, $2, $3)) AS geom{selected}
+            FROM {table}
+            WHERE geom && ST_Transform(ST_TileEnvelope($1, $2, $3), 4326)
+            LIMIT $4
+        )
+        SELECT ST_AsMVT(mvtgeom.*, '{layer}'), count(*)
+        FROM mvtgeom""",
+        # $4四方のグリッドで点をまとめ、重心に点数（point_count）を持たせる
+        f"{name}_tile_clustered": f"""WITH clusters AS (
+            SELECT count(*) AS point_count,
+                ST_Centroid(ST_Collect(ST_Transform(geom, 3857))) AS geom{representative}
+            FROM {table}
+            WHERE geom && ST_Transform(ST_TileEnvelope($1, $2, $3), 4326)
+            -- 格子点をセルの中心に置く（原点を半セルずらす）と、セルの境界がタイルの境界と一致する
+            -- （原点からの最寄りの格子点に丸めると、タイルの境界をまたぐセルができる）
+            GROUP BY ST_SnapToGrid(ST_Transform(geom, 3857), $4::float8 / 2, $4::float8 / 2, $4, $4)
+        ), mvtgeom AS (
+            SELECT ST_AsMVTGeom(geom, ST_TileEnvelope($1, $2, $3)) AS geom,
+                point_count{selected}
+            FROM clusters
+        )
+        SELECT ST_AsMVT(mvtgeom.*, '{layer}'), count(*)
+        FROM mvtgeom""",
+    }
+
+
+# schoolテーブルからタイルを生成するクエリ。APIとscripts/seed.pyで共通に使う
+# コネクションごとにサーバー側でプリペアして使い回す
+PREPARED_STATEMENTS = tile_statements("school", "school")
+
+
+def render_layer_tile(
+    cur, execute: Callable, name: str, z: int, x: int, y: int
+) -> bytes:
+    """
+    tile_statementsで作成したクエリnameでタイルを生成する
+
+    execute(cur, name, params)でプリペアドステートメントを実行する。
+    低いズームレベルや点が多すぎる範囲では、点をまとめてタイルを小さく保つ。
+    """
+
+    def render(statement: str, param) -> tuple[bytes, int]:
+        execute(cur, statement, (z, x, y, param))
+        val, count = cur.fetchone()
+        return val.tobytes(), count
+
+    return render_within_budget(
+        z,
+        lambda limit: render(f"{name}_tile", limit),
+        lambda cell_size: render(f"{name}_tile_clustered", cell_size),
+    )
+
+
+def render_school_tile(cur, execute: Callable, z: int, x: int, y: int) -> bytes:
+    """
+    schoolテーブルの地物からタイルを生成する
+    """
+    return render_layer_tile(cur, execute, "school", z, x, y)
@@ -0,0 +1,295 @@
+import codecs
+import csv
+import io
+import json
+import re
+from typing import AsyncIterator, Iterator, Literal, Optional, Type, Union
+
+from pydantic import BaseModel, ValidationError
+from starlette.concurrency import run_in_threadpool
+
+from app.db import ConnectionPool
+from app.geojson import dumps
+
+# geojson: GeoJSON-FeatureCollection
+# geojsonseq: 1行に1つのGeoJSON-Featureを並べた形式（GeoJSONSeq）
+# csv: 1行目がヘッダーのCSV（列名はモデルのフィールド名）
+ImportFormat = Literal["geojson", "geojsonseq", "csv"]
+# 1回のCOPYで書き込む行数
+IMPORT_BATCH_SIZE = 5000
+
+# モデルのフィールドの型 -> 一時テーブルの列の型
+COLUMN_TYPES = {str: "text", float: "double precision", int: "bigint"}
+
+# FeatureSplitterが調べる文字
+JSON_SPECIAL = re.compile(r'["\\{}\[\]]')
+
+
+class FeatureSplitter:
+    """
+    GeoJSON-FeatureCollectionの文字列を少しずつ受け取り、features配列の要素を切り出す
+
+    全体を読み込まずに済むよう、切り出し中の要素の分だけを保持する。
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._skip = -1
+        # FeatureCollection直下のキーの開始位置と、直前のキー
+        self._key_start: Optional[int] = None
+        self._last_key: Optional[str] = None
+        self._in_features = False
+        # 切り出し中の要素の開始位置
+        self._start: Optional[int] = None
+
+    def feed(self, text: str) -> list[str]:
+        buffer = self._buffer = self._buffer + text
+        items = []
+        for match in JSON_SPECIAL.finditer(buffer, self._pos):
+            i = match.start()
+            c = match.group()
+            if i <= self._skip:
+                # エスケープされた文字
+                continue
+            if self._in_string:
+                if c == "\\":
+                    self._skip = i + 1
+                elif c == '"':
+                    self._in_string = False
+                    if self._key_start is not None:
+                        self._last_key = buffer[self._key_start : i]
+                        self._key_start = None
+                continue
+
+            if c == '"':
+                self._in_string = True
+                if self._depth == 1:
+                    self._key_start = i + 1
+            elif c in "{[":
+                if self._depth == 1 and c == "[" and self._last_key == "features":
+                    self._in_features = True
+                elif self._depth == 2 and self._in_features and c == "{":
+                    self._start = i
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._depth == 2 and self._in_features and c == "}":
+                    items.append(buffer[self._start : i + 1])
+                    self._start = None
+                elif self._depth == 1:
+                    self._in_features = False
+
+        # 切り出し中の要素や読み途中のキーより前の部分は捨てる
+        keep = len(buffer)
+        for position in (self._start, self._key_start):
+            if position is not None and position < keep:
+                keep = position
+        self._buffer = buffer[keep:]
+        self._pos = len(buffer) - keep
+        if self._start is not None:
+            self._start -= keep
+        if self._key_start is not None:
+            self._key_start -= keep
+        # エスケープされた文字が次に受け取る文字列の先頭にある場合だけ、位置を持ち越す
+        self._skip = self._skip - keep if self._skip >= len(buffer) else -1
+        return items
+
+
+async def read_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    rest = ""
+    async for chunk in chunks:
+        lines = (rest + decoder.decode(chunk)).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    rest += decoder.decode(b"", final=True)
+    if rest:
+        yield rest
+
+
+async def read_items(
+    chunks: AsyncIterator[bytes], format: ImportFormat
+) -> AsyncIterator[Union[str, dict]]:
+    """
+    リクエストボディを少しずつ読み、GeoJSON-Featureの文字列またはCSVの行を順に返す
+    """
+    if format == "geojson":
+        decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        splitter = FeatureSplitter()
+        async for chunk in chunks:
+            for item in splitter.feed(decoder.decode(chunk)):
+                yield item
+        return
+
+    header = None
+    async for line in read_lines(chunks):
+        # GeoJSONSeqの各行の先頭にはRS(0x1E)が付く場合がある
+        line = line.strip().lstrip("\x1e")
+        if not line:
+            continue
+        if format == "geojsonseq":
+            yield line
+            continue
+        # CSVの値に改行を含めることはできない
+        row = next(csv.reader([line]))
+        if header is None:
+            header = row
+            continue
+        if len(row) != len(header):
+            yield {"__error__": f"列の数がヘッダーと一致しません: {len(row)}"}
+            continue
+        yield dict(zip(header, row))
+
+
+def feature_record(feature: dict) -> dict:
+    """
+    Point地物のGeoJSON-Featureを、属性とlongitude, latitudeのdictにする
+    """
+    geometry = feature.get("geometry") or {}
+    if geometry.get("type") != "Point":
+        raise ValueError("ジオメトリはPointのみ対応しています")
+    longitude, latitude = geometry["coordinates"][:2]
+    return {
+        **(feature.get("properties") or {}),
+        "longitude": longitude,
+        "latitude": latitude,
+    }
+
+
+def error_message(e: Exception) -> str:
+    if isinstance(e, ValidationError):
+        return "; ".join(
+            f"{'.'.join(map(str, error['loc']))}: {error['msg']}"
+            for error in e.errors()
+        )
+    return f"{type(e).__name__}: {e}"
+
+
+def to_row(item: Union[str, dict], model: Type[BaseModel]) -> tuple:
+    if isinstance(item, str):
+        record = feature_record(json.loads(item))
+    elif "__error__" in item:
+        raise ValueError(item["__error__"])
+    else:
+        record = item
+    return tuple(model.model_validate(record).model_dump().values())
+
+
+def copy_rows(cur, table: str, columns: list[str], rows: list[tuple]):
+    if not rows:
+        return
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    cur.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf
+    )
+
+
+async def bulk_import(
+    pool: ConnectionPool,
+    chunks: AsyncIterator[bytes],
+    format: ImportFormat,
+    model: Type[BaseModel],
+    table: str,
+    insert_sql: str,
+) -> Iterator[str]:
+    """
+    リクエストボディの地物をCOPYでまとめてtableに追加し、結果を1行ずつ返すイテレーターを返す
+
+    ボディは少しずつ読み、IMPORT_BATCH_SIZE行ごとにmodelで検証して一時テーブル
+    （{table}_importと{table}_import_errors）へCOPYする。
+    最後にinsert_sqlで一時テーブルからtableへ追加する。ここまでを1つのトランザクションで行う。
+    一時テーブルのidには、あらかじめtableのシーケンスから値を割り当てておく。
+    結果は入力の行番号の順に{"row", "id"}または{"row", "error"}を1行ずつ並べ、
+    最後に件数を返す（JSON Lines）。
+    """
+    fields = list(model.model_fields)
+    staging = f"{table}_import"
+    errors_table = f"{table}_import_errors"
+    columns = ", ".join(
+        f"{name} {COLUMN_TYPES[info.annotation]}"
+        for name, info in model.model_fields.items()
+    )
+
+    def create_staging(conn):
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {staging}, {errors_table}")
+            cur.execute(
+                f"""CREATE TEMP TABLE {staging} (
+                    n integer PRIMARY KEY,
+                    id integer DEFAULT nextval(pg_get_serial_sequence('{table}', 'id')),
+                    {columns}
+                )"""
+            )
+            cur.execute(f"CREATE TEMP TABLE {errors_table} (n integer, error text)")
+
+    def copy_batch(conn, rows: list[tuple], errors: list[tuple]):
+        with conn.cursor() as cur:
+            copy_rows(cur, staging, ["n", *fields], rows)
+            copy_rows(cur, errors_table, ["n", "error"], errors)
+
+    def insert(conn):
+        with conn.cursor() as cur:
+            cur.execute(insert_sql)
+        conn.commit()
+
+    conn = await pool.agetconn()
+    created = failed = 0
+    try:
+        await run_in_threadpool(create_staging, conn)
+        rows: list[tuple] = []
+        errors: list[tuple] = []
+        n = 0
+        async for item in read_items(chunks, format):
+            n += 1
+            try:
+                rows.append((n, *to_row(item, model)))
+            except (ValueError, ValidationError, KeyError, TypeError) as e:
+                errors.append((n, error_message(e)))
+            if len(rows) + len(errors) >= IMPORT_BATCH_SIZE:
+                await run_in_threadpool(copy_batch, conn, rows, errors)
+                created += len(rows)
+                failed += len(errors)
+                rows, errors = [], []
+        await run_in_threadpool(copy_batch, conn, rows, errors)
+        created += len(rows)
+        failed += len(errors)
+        await run_in_threadpool(insert, conn)
+    except BaseException:
+        # 途中のトランザクションは破棄される
+        await pool.aputconn(conn)
+        raise
+
+    def results() -> Iterator[str]:
+        try:
+            with conn.cursor(name="import_results") as cur:
+                cur.execute(
+                    f"""SELECT n, id, NULL FROM {staging}
+                    UNION ALL SELECT n, NULL, error FROM {errors_table}
+                    ORDER BY 1"""
+                )
+                yield ""
+                for n, id, error in cur:
+                    if error is None:
+                        yield dumps({"row": n, "id": id}) + "\n"
+                    else:
+                        yield dumps({"row": n, "error": error}) + "\n"
+            yield dumps({"created": created, "errors": failed}) + "\n"
+        finally:
+            try:
+                conn.rollback()
+                with conn.cursor() as cur:
+                    cur.execute(f"DROP TABLE IF EXISTS {staging}, {errors_table}")
+                conn.commit()
+            finally:
+                pool.putconn(conn)
+
+    iterator = results()
+    # 結果を返すカーソルを開くまで進めておき、以降は最後まで読まれなくてもコネクションを返す
+    await run_in_threadpool(next, iterator)
+    return iterator
@@ -0,0 +1,238 @@
+import asyncio
+import json
+import select
+import threading
+import time
+import weakref
+from typing import AsyncIterator, Optional, Sequence
+
+import psycopg2
+
+from app.db import ConnectionPool
+from app.geojson import dumps
+
+# 1回に返す変更の数の上限。超える場合はhasMoreを返し、続きは次の問い合わせで返す
+CHANGES_LIMIT = 5000
+# SSEの購読者ごとに溜めておける変更のまとまりの数
+# 超えた購読者は接続を切り、再接続（Last-Event-ID）で追いつかせる
+SUBSCRIBER_QUEUE_SIZE = 100
+# 変更がなくても接続を保つため、コメントを送る間隔（秒）
+KEEPALIVE_INTERVAL = 30
+
+
+def changes_sql(table: str, columns: Sequence[str] = ()) -> str:
+    """
+    バージョン%(since)sより後、%(until)s以下の変更を、バージョンの順に%(limit)s件まで返すクエリ
+
+    結果の列は、バージョン、id、削除されたか、経度、緯度、columnsの順。
+    """
+    selected = "".join(f", {c}" for c in columns)
+    nulls = ", NULL" * len(columns)
+    return f"""(
+        SELECT version, id, false, ST_X(geom), ST_Y(geom){selected}
+        FROM {table} WHERE version > %(since)s AND version <= %(until)s
+        ORDER BY version LIMIT %(limit)s
+    ) UNION ALL (
+        SELECT version, id, true, NULL, NULL{nulls}
+        FROM {table}_tombstone WHERE version > %(since)s AND version <= %(until)s
+        ORDER BY version LIMIT %(limit)s
+    )
+    ORDER BY 1 LIMIT %(limit)s"""
+
+
+def sse_message(version: int, data: dict) -> str:
+    # idを付けておくと、ブラウザのEventSourceは再接続時にLast-Event-IDとして送る
+    return f"id: {version}\nevent: change\ndata: {dumps(data)}\n\n"
+
+
+class Subscriber:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+    def put(self, version: int, message: str):
+        # イベントループのスレッドで呼ばれる
+        if self.overflowed:
+            return
+        if self.queue.full():
+            # 読み出しが追いつかない。溜まった変更を捨て、Noneで接続を切らせる
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+            return
+        self.queue.put_nowait((version, message))
+
+
+class ChangeFeed:
+    """
+    テーブルの変更（追加・更新・削除）を、バージョンを指定して差分で返す
+
+    各行にはトリガーで変更のたびにバージョン（全テーブルで共通の単調増加の値）が振られ、
+    削除した行は{テーブル名}_tombstoneにバージョンとともに残る。
+    バージョンは振られた順にコミットされるとは限らないため、
+    まだコミットされていない変更がないバージョン（change_version_watermark）までを返す。
+    SSEの購読者には、1つのコネクションでLISTENした変更の通知をもとに
+    変更を1回だけ読み込み、すべての購読者に配る。
+    layersはテーブル名と、変更とともに返す列の一覧。
+    """
+
+    def __init__(
+        self,
+        dsn: str,
+        pool: ConnectionPool,
+        layers: dict[str, Sequence[str]],
+        channel: str = "feature_change",
+    ):
+        self.dsn = dsn
+        self.pool = pool
+        self.layers = layers
+        self.channel = channel
+        self._sql = {
+            layer: changes_sql(layer, columns) for layer, columns in layers.items()
+        }
+        self._subscribers: dict[str, weakref.WeakSet[Subscriber]] = {
+            layer: weakref.WeakSet() for layer in layers
+        }
+        self._lock = threading.Lock()
+        # 購読者に配り終えた変更のバージョン
+        self._versions: dict[str, int] = {}
+
+    def fetch(self, conn, layer: str, since: int, limit: int = CHANGES_LIMIT) -> dict:
+        """
+        バージョンsinceより後の変更を返す
+
+        featuresは追加・更新された地物（現在の内容）、deletedは削除された地物のID、
+        versionは返した変更の最後のバージョン（次の問い合わせのsinceに指定する）。
+        """
+        columns = self.layers[layer]
+        with conn.cursor() as cur:
+            # 上限を求めてから、別の文（新しいスナップショット）で変更を読む
+            cur.execute("SELECT change_version_watermark()")
+            until = cur.fetchone()[0]
+            cur.execute(
+                self._sql[layer], {"since": since, "until": until, "limit": limit}
+            )
+            rows = cur.fetchall()
+        features = []
+        deleted = []
+        for version, id, is_deleted, longitude, latitude, *values in rows:
+            if is_deleted:
+                deleted.append(id)
+                continue
+            features.append(
+                {
+                    "type": "Feature",
+                    "geometry": {
+                        "type": "Point",
+                        "coordinates": [longitude, latitude],
+                    },
+                    "properties": {"id": id, **dict(zip(columns, values))},
+                }
+            )
+        return {
+            "type": "FeatureCollection",
+            "version": rows[-1][0] if rows else since,
+            "hasMore": len(rows) == limit,
+            "features": features,
+            "deleted": deleted,
+        }
+
+    def listen(self):
+        """
+        変更の通知を受け取り、購読者に配るスレッドを開始する
+        """
+        thread = threading.Thread(target=self._listen, daemon=True)
+        thread.start()
+        return thread
+
+    def _listen(self):
+        while True:
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.channel}")
+                    # 初回は、コミット済みの変更の後から配る
+                    cur.execute("SELECT change_version_watermark()")
+                    watermark = cur.fetchone()[0]
+                    for layer in self.layers:
+                        self._versions.setdefault(layer, watermark)
+                # 接続していなかった間の変更を配る
+                for layer in self.layers:
+                    self._publish(conn, layer)
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    layers = set()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        layers.add(json.loads(notify.payload)["layer"])
+                    for layer in layers & self.layers.keys():
+                        self._publish(conn, layer)
+            except psycopg2.Error:
+                # 接続が切れたら少し待って接続し直す
+                time.sleep(1)
+
+    def _publish(self, conn, layer: str):
+        while True:
+            changes = self.fetch(conn, layer, self._versions[layer])
+            if not changes["features"] and not changes["deleted"]:
+                return
+            version = self._versions[layer] = changes["version"]
+            # 購読者の数によらず、シリアライズは1回だけ行う
+            message = sse_message(version, changes)
+            with self._lock:
+                subscribers = list(self._subscribers[layer])
+            for subscriber in subscribers:
+                subscriber.loop.call_soon_threadsafe(subscriber.put, version, message)
+            if not changes["hasMore"]:
+                return
+
+    async def stream(self, layer: str, since: int) -> AsyncIterator[str]:
+        """
+        バージョンsinceより後の変更を、Server-Sent Eventsのメッセージとして順に返す
+
+        まずsinceより後の変更を返し、以降はコミットされた変更を届いた順に返す。
+        """
+        subscriber = Subscriber(asyncio.get_running_loop())
+        # 読み込みの途中にコミットされた変更も受け取れるよう、先に購読する
+        with self._lock:
+            self._subscribers[layer].add(subscriber)
+        # コネクションを取得できない場合は、レスポンスを始める前にエラーにする
+        changes = await self.pool.run(self.fetch, layer, since)
+        return self._events(layer, subscriber, changes)
+
+    async def _events(
+        self, layer: str, subscriber: Subscriber, changes: dict
+    ) -> AsyncIterator[str]:
+        try:
+            while True:
+                if changes["features"] or changes["deleted"]:
+                    yield sse_message(changes["version"], changes)
+                if not changes["hasMore"]:
+                    break
+                changes = await self.pool.run(self.fetch, layer, changes["version"])
+            position = changes["version"]
+
+            while True:
+                try:
+                    item: Optional[tuple[int, str]] = await asyncio.wait_for(
+                        subscriber.queue.get(), KEEPALIVE_INTERVAL
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if item is None:
+                    return
+                version, message = item
+                # 読み込み済みの変更は送らない
+                # それより後に読み込まれた変更は、地物の現在の内容なので送り直しても問題ない
+                if version > position:
+                    position = version
+                    yield message
+        finally:
+            with self._lock:
+                self._subscribers[layer].discard(subscriber)
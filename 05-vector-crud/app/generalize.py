@@ -0,0 +1,55 @@
+from typing import Callable
+
+# ウェブメルカトルでの赤道の長さ（メートル）
+WORLD_SIZE = 40075016.685578488
+# このズームレベル未満では、点をグリッドでまとめた代表点（クラスター）として描画する
+CLUSTER_MAXZOOM = 12
+# クラスタリングのグリッドの細かさ（タイルの一辺あたりのセル数）
+CLUSTER_GRID = 64
+# タイルが上限に収まらない場合は、グリッドをこの細かさまで粗くする
+MIN_CLUSTER_GRID = 4
+# 1タイルに含める地物の数と、タイルのサイズの上限
+MAX_TILE_FEATURES = 10000
+MAX_TILE_BYTES = 512 * 1024
+
+# (タイル, 地物の数)を返す関数
+RenderPoints = Callable[[int], tuple[bytes, int]]
+RenderClusters = Callable[[float], tuple[bytes, int]]
+
+
+def cell_size(z: int, grid: int) -> float:
+    """
+    タイルの一辺をgrid個に分けたセルの大きさ（ウェブメルカトルのメートル）
+
+    タイルの一辺の長さの整数分の1なので、原点（ウェブメルカトルの座標の0）から
+    セルの大きさごとに区切れば、セルはタイルの境界をまたがない。
+    """
+    return WORLD_SIZE / 2**z / grid
+
+
+def within_budget(tile: bytes, count: int) -> bool:
+    return count <= MAX_TILE_FEATURES and len(tile) <= MAX_TILE_BYTES
+
+
+def render_within_budget(
+    z: int, render_points: RenderPoints, render_clusters: RenderClusters
+) -> bytes:
+    """
+    ズームレベルとタイルの大きさの上限に応じて、点をそのまま、またはクラスターとして描画する
+
+    render_points(limit)はlimit件までの点を描画し、render_clusters(cell_size)は
+    cell_size四方のセルごとに点をまとめて描画する。
+    点が多すぎるタイルはクラスターに切り替え、それでも大きすぎればグリッドを粗くする。
+    """
+    if z >= CLUSTER_MAXZOOM:
+        # 上限を1件超えて取得し、超えていればクラスターに切り替える
+        tile, count = render_points(MAX_TILE_FEATURES + 1)
+        if within_budget(tile, count):
+            return tile
+
+    grid = CLUSTER_GRID
+    while True:
+        tile, count = render_clusters(cell_size(z, grid))
+        if within_budget(tile, count) or grid <= MIN_CLUSTER_GRID:
+            return tile
+        grid //= 2
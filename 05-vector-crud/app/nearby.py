@@ -0,0 +1,122 @@
+from typing import Optional, Sequence
+
+# 1点あたりに返す地物の数の上限
+MAX_NEAREST = 1000
+# まとめて問い合わせる場合の、点の数と1点あたりに返す地物の数の上限
+MAX_BATCH_POINTS = 1000
+MAX_BATCH_NEAREST = 100
+# 距離で絞り込む場合の上限（メートル）
+MAX_RADIUS = 100_000
+
+# 経緯度1度あたりの長さ（メートル）の下限
+# 緯度方向は赤道での値、経度方向は赤道での値にcos(緯度)を掛けた値より短くならない
+METERS_PER_DEGREE_LAT = 110574
+METERS_PER_DEGREE_LON = 111319
+
+
+def within_meters(table: str, point: str, lat: str, meters: str) -> str:
+    """
+    pointからmetersメートル以内の地物を絞り込む条件
+
+    距離の計算（geography）では空間インデックスを使えないため、
+    先にmetersメートルを含む経緯度の矩形（&&）でインデックスを使って絞り込む。
+    """
+    dy = f"({meters} / {METERS_PER_DEGREE_LAT})"
+    # 矩形の中で極に近い側の緯度で、経度1度あたりの長さが最も短くなる
+    far_lat = f"least(abs({lat}) + {dy}, 89.9)"
+    dx = f"({meters} / ({METERS_PER_DEGREE_LON} * cos(radians({far_lat}))))"
+    return f"""{table}.geom && ST_Expand({point}, {dx}, {dy})
+            AND ST_DWithin({table}.geom::geography, {point}::geography, {meters})"""
+
+
+def nearest_sql(table: str, columns: Sequence[str] = ()) -> str:
+    """
+    問い合わせる点ごとに、tableの地物を近い順に返すクエリ
+
+    パラメータは%(lons)s, %(lats)s（点の経度と緯度の配列）、%(k)s（1点あたりの件数）、
+    %(radius)s（距離の上限（メートル）。NULLなら制限しない）。
+    結果の列は、点の番号（1始まり）、id、経度、緯度、距離（メートル）、columnsの順。
+    すべての点をLATERAL JOINで1つのクエリにまとめて検索する。
+    """
+    selected = "".join(f", t.{c}" for c in columns)
+    radius = "%(radius)s::float8"
+    return f"""WITH query AS (
+        SELECT n, lat, ST_SetSRID(ST_MakePoint(lon, lat), 4326) AS geom
+        FROM unnest(%(lons)s::float8[], %(lats)s::float8[]) WITH ORDINALITY AS q (lon, lat, n)
+    )
+    SELECT query.n, nearest.*
+    FROM query
+    -- 1: 空間インデックス（<->）で経緯度での距離の近い順にk件取り出し、最も遠い地物までの距離を求める
+    CROSS JOIN LATERAL (
+        SELECT max(ST_Distance(t.geom::geography, query.geom::geography)) AS reach
+        FROM (
+            SELECT t.geom FROM {table} t
+            WHERE {radius} IS NULL OR ({within_meters("t", "query.geom", "query.lat", radius)})
+            ORDER BY t.geom <-> query.geom
+            LIMIT %(k)s
+        ) t
+    ) bound
+    -- 2: 経緯度での距離の順は実際の距離（メートル）の順と一致しないため、
+    --    その距離以内をあらためて検索し、実際の距離の順にk件返す
+    CROSS JOIN LATERAL (
+        SELECT t.id, ST_X(t.geom), ST_Y(t.geom),
+            ST_Distance(t.geom::geography, query.geom::geography) AS distance{selected}
+        FROM {table} t
+        -- 計算誤差で最も遠い地物が漏れないよう、わずかに広げる
+        WHERE {within_meters("t", "query.geom", "query.lat", "(bound.reach + 0.01)")}
+        ORDER BY distance
+        LIMIT %(k)s
+    ) nearest
+    ORDER BY query.n, nearest.distance"""
+
+
+def fetch_nearest(
+    conn,
+    sql: str,
+    points: Sequence[tuple[float, float]],
+    k: int,
+    radius: Optional[float] = None,
+) -> list[list[tuple]]:
+    """
+    nearest_sqlのクエリを実行し、点ごとの結果（id, 経度, 緯度, 距離, ...）のリストを返す
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            sql,
+            {
+                "lons": [lon for lon, _ in points],
+                "lats": [lat for _, lat in points],
+                "k": k,
+                "radius": radius,
+            },
+        )
+        results: list[list[tuple]] = [[] for _ in points]
+        for n, *row in cur:
+            results[n - 1].append(tuple(row))
+    return results
+
+
+def nearest_collection(rows: list[tuple], columns: Sequence[str] = ()) -> dict:
+    """
+    fetch_nearestの1点分の結果を、近い順のGeoJSON-FeatureCollectionにする
+
+    各地物のpropertiesには、columnsの値と距離（distance、メートル）を含める。
+    """
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": [longitude, latitude],
+                },
+                "properties": {
+                    "id": id,
+                    **dict(zip(columns, values)),
+                    "distance": distance,
+                },
+            }
+            for id, longitude, latitude, distance, *values in rows
+        ],
+    }
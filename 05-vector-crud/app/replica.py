@@ -0,0 +1,333 @@
+import heapq
+import json
+import math
+import os
+import select
+import threading
+import time
+from array import array
+from typing import Iterator, Optional
+
+import psycopg2
+
+# 1にすると、APIのプロセス内にpoiテーブルの複製を持ち、範囲検索などに使う
+POI_REPLICA = os.environ.get("POI_REPLICA") == "1"
+# R-treeの1ノードあたりの子の数
+NODE_SIZE = 16
+# 差分がこの件数を超えたら、索引を作り直す
+REBUILD_THRESHOLD = 1000
+
+Poi = tuple[int, str, float, float]
+
+
+class PackedRTree:
+    """
+    点の配列から一度に作成する、変更できないR-tree（STR法）
+
+    各ノードの範囲は階層ごとの配列に保持し、葉のノードは点の配列の連続する範囲を指す。
+    """
+
+    def __init__(self, lons: array, lats: array):
+        n = len(lons)
+        # 点をSTR法の順に並べ替えた添字
+        self.order = self._str_order(list(range(n)), lons, lats)
+        # levels[0]が葉。各階層はノードごとの(minx, miny, maxx, maxy)を並べた配列
+        self.levels: list[array] = []
+        boxes = array("d")
+        for start in range(0, n, NODE_SIZE):
+            chunk = self.order[start : start + NODE_SIZE]
+            xs = [lons[i] for i in chunk]
+            ys = [lats[i] for i in chunk]
+            boxes.extend((min(xs), min(ys), max(xs), max(ys)))
+        self.levels.append(boxes)
+        while len(boxes) > 4:
+            boxes = self._pack(boxes)
+            self.levels.append(boxes)
+
+    @staticmethod
+    def _str_order(indexes: list[int], xs, ys) -> list[int]:
+        """
+        x座標で縦長の帯に分け、帯ごとにy座標で並べる
+        """
+        n = len(indexes)
+        if n == 0:
+            return []
+        leaves = math.ceil(n / NODE_SIZE)
+        slab = NODE_SIZE * math.ceil(math.sqrt(leaves))
+        indexes = sorted(indexes, key=lambda i: xs[i])
+        order = []
+        for start in range(0, n, slab):
+            order.extend(sorted(indexes[start : start + slab], key=lambda i: ys[i]))
+        return order
+
+    @staticmethod
+    def _pack(boxes: array) -> array:
+        # 子ノードは作成時に並べた順のまま、NODE_SIZE個ずつまとめる
+        parents = array("d")
+        for start in range(0, len(boxes), NODE_SIZE * 4):
+            chunk = boxes[start : start + NODE_SIZE * 4]
+            parents.extend(
+                (min(chunk[0::4]), min(chunk[1::4]), max(chunk[2::4]), max(chunk[3::4]))
+            )
+        return parents
+
+    def search(
+        self, minx: float, miny: float, maxx: float, maxy: float
+    ) -> Iterator[int]:
+        """
+        範囲と重なる葉のノードの点の添字を返す（点ごとの判定は呼び出し側で行う）
+        """
+        if not self.order:
+            return
+        top = len(self.levels) - 1
+        stack = [(top, i) for i in range(len(self.levels[top]) // 4)]
+        while stack:
+            level, node = stack.pop()
+            boxes = self.levels[level]
+            k = node * 4
+            if (
+                boxes[k] > maxx
+                or boxes[k + 1] > maxy
+                or boxes[k + 2] < minx
+                or boxes[k + 3] < miny
+            ):
+                continue
+            if level == 0:
+                yield from self.order[node * NODE_SIZE : (node + 1) * NODE_SIZE]
+                continue
+            children = len(self.levels[level - 1]) // 4
+            for child in range(
+                node * NODE_SIZE, min((node + 1) * NODE_SIZE, children)
+            ):
+                stack.append((level - 1, child))
+
+
+class Snapshot:
+    """
+    ある時点のpoiテーブルの内容と、その索引
+    """
+
+    def __init__(self, rows: list[Poi]):
+        rows = sorted(rows)
+        self.ids = array("q", (row[0] for row in rows))
+        self.names = [row[1] for row in rows]
+        self.lons = array("d", (row[2] for row in rows))
+        self.lats = array("d", (row[3] for row in rows))
+        self.tree = PackedRTree(self.lons, self.lats)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def row(self, i: int) -> Poi:
+        return self.ids[i], self.names[i], self.lons[i], self.lats[i]
+
+
+class PoiReplica:
+    """
+    poiテーブルの内容をAPIのプロセス内に複製し、範囲検索に答える
+
+    起動時にテーブル全体を読み込んで索引（PackedRTree）を作り、
+    以降はトリガーからのpoi_changeの通知で変更された地物だけを読み直して差分に反映する。
+    変更は通知からだけ反映する（通知ごとに地物の最新の内容を読むため、順序が入れ替わらない）。
+    APIでの変更も、通知を受け取るまで（通常は数ミリ秒）は複製に含まれない。
+    差分がREBUILD_THRESHOLDを超えたら、差分を取り込んだ索引を別のスレッドで作り直す。
+    """
+
+    def __init__(self, dsn: str, channel: str = "poi_change"):
+        self.dsn = dsn
+        self.channel = channel
+        self._snapshot = Snapshot([])
+        # id -> 地物。Noneは削除された地物
+        self._delta: dict[int, Optional[Poi]] = {}
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self.ready = False
+        self.events = 0
+        self.loaded_at: Optional[float] = None
+        self.last_event_at: Optional[float] = None
+        # 最後に反映した変更の、コミットから反映までの秒数
+        self.lag: Optional[float] = None
+
+    def start(self):
+        thread = threading.Thread(target=self._listen, daemon=True)
+        thread.start()
+        return thread
+
+    def _listen(self):
+        while True:
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    # 読み込み中の変更も受け取れるよう、先にLISTENする
+                    cur.execute(f"LISTEN {self.channel}")
+                    # 接続していなかった間の通知は受け取れないため、すべて読み直す
+                    self._load(cur)
+                    while True:
+                        if select.select([conn], [], [], 60) == ([], [], []):
+                            continue
+                        conn.poll()
+                        while conn.notifies:
+                            notify = conn.notifies.pop(0)
+                            self._apply(cur, json.loads(notify.payload))
+            except psycopg2.Error:
+                # 接続が切れたら少し待って接続し直す
+                self.ready = False
+                time.sleep(1)
+
+    def _load(self, cur):
+        cur.execute("SELECT id, name, ST_X(geom), ST_Y(geom) FROM poi")
+        snapshot = Snapshot(cur.fetchall())
+        with self._lock:
+            self._snapshot = snapshot
+            self._delta = {}
+        self.loaded_at = time.time()
+        self.ready = True
+
+    def _apply(self, cur, change: dict):
+        if change["op"] == "reload":
+            # 一括登録などで、まとめて変更された
+            self._load(cur)
+        else:
+            cur.execute(
+                "SELECT id, name, ST_X(geom), ST_Y(geom) FROM poi WHERE id = %s",
+                (change["id"],),
+            )
+            row = cur.fetchone()
+            with self._lock:
+                self._delta[change["id"]] = row
+            self._maybe_rebuild()
+        self.events += 1
+        self.last_event_at = time.time()
+        self.lag = self.last_event_at - change["ts"]
+
+    def _maybe_rebuild(self):
+        if len(self._delta) <= REBUILD_THRESHOLD:
+            return
+        # 作り直している途中なら任せる
+        if not self._rebuild_lock.acquire(blocking=False):
+            return
+        # 通知の反映を止めないよう、別のスレッドで作り直す
+        threading.Thread(target=self._rebuild_and_release, daemon=True).start()
+
+    def _rebuild_and_release(self):
+        try:
+            self._rebuild()
+        finally:
+            self._rebuild_lock.release()
+
+    def _rebuild(self):
+        with self._lock:
+            snapshot, delta = self._snapshot, dict(self._delta)
+        rows = [
+            snapshot.row(i)
+            for i in range(len(snapshot))
+            if snapshot.ids[i] not in delta
+        ]
+        rows.extend(row for row in delta.values() if row is not None)
+        rebuilt = Snapshot(rows)
+        with self._lock:
+            if self._snapshot is not snapshot:
+                # 作り直している間に、テーブル全体が読み直された
+                return
+            # 作り直している間に反映された差分は残す
+            self._snapshot = rebuilt
+            self._delta = {
+                id: row for id, row in self._delta.items() if delta.get(id, 0) != row
+            }
+
+    def _view(self) -> tuple[Snapshot, dict[int, Optional[Poi]]]:
+        with self._lock:
+            return self._snapshot, dict(self._delta)
+
+    @staticmethod
+    def _matches(
+        snapshot: Snapshot,
+        delta: dict[int, Optional[Poi]],
+        minx: float,
+        miny: float,
+        maxx: float,
+        maxy: float,
+        after: int = 0,
+    ) -> Iterator[tuple[int, Optional[int], Optional[Poi]]]:
+        """
+        範囲内でIDがafterより大きい地物の(id, 索引の添字, 差分の地物)を、順不同で返す
+        地物の値の組は作らない
+        """
+        ids, lons, lats = snapshot.ids, snapshot.lons, snapshot.lats
+        for i in snapshot.tree.search(minx, miny, maxx, maxy):
+            id = ids[i]
+            if (
+                id > after
+                and id not in delta
+                and minx <= lons[i] <= maxx
+                and miny <= lats[i] <= maxy
+            ):
+                yield id, i, None
+        for id, row in delta.items():
+            if (
+                row is not None
+                and id > after
+                and minx <= row[2] <= maxx
+                and miny <= row[3] <= maxy
+            ):
+                yield id, None, row
+
+    def search(
+        self,
+        minx: float,
+        miny: float,
+        maxx: float,
+        maxy: float,
+        after: int = 0,
+        limit: Optional[int] = None,
+    ) -> list[Poi]:
+        """
+        範囲内でIDがafterより大きい地物を、IDの順にlimit件まで返す
+
+        範囲内のすべてを並べ替えずに、IDの小さいlimit件だけを選ぶ。
+        """
+        snapshot, delta = self._view()
+        matches = self._matches(snapshot, delta, minx, miny, maxx, maxy, after)
+        if limit is None:
+            selected = sorted(matches, key=lambda match: match[0])
+        else:
+            selected = heapq.nsmallest(limit, matches, key=lambda match: match[0])
+        return [
+            row if row is not None else snapshot.row(i) for _, i, row in selected
+        ]
+
+    def count(self, minx: float, miny: float, maxx: float, maxy: float) -> int:
+        snapshot, delta = self._view()
+        return sum(1 for _ in self._matches(snapshot, delta, minx, miny, maxx, maxy))
+
+    def all(self) -> Iterator[Poi]:
+        """
+        すべての地物をIDの順に返す
+        """
+        with self._lock:
+            snapshot, delta = self._snapshot, dict(self._delta)
+        added = sorted(row for row in delta.values() if row is not None)
+        j = 0
+        for i in range(len(snapshot)):
+            id = snapshot.ids[i]
+            while j < len(added) and added[j][0] < id:
+                yield added[j]
+                j += 1
+            if id not in delta:
+                yield snapshot.row(i)
+        yield from added[j:]
+
+    def status(self) -> dict:
+        with self._lock:
+            size = len(self._snapshot)
+            delta = len(self._delta)
+        return {
+            "ready": self.ready,
+            "indexed": size,
+            "delta": delta,
+            "events": self.events,
+            "loaded_at": self.loaded_at,
+            "last_event_at": self.last_event_at,
+            "lag_seconds": self.lag,
+        }
@@ -0,0 +1,275 @@
+import json
+import logging
+import math
+import select
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+# Webメルカトルで表現できる緯度の上限
+MAX_LATITUDE = 85.0511287798066
+# ST_AsMVTGeomの既定のバッファ（タイルの一辺4096に対して256）
+TILE_BUFFER = 256 / 4096
+# キャッシュの1件ごとに、タイルのサイズに加えて数えるサイズ（キーや辞書の分）
+# 地物のない空のタイルも上限の対象にし、件数が際限なく増えないようにする
+TILE_ENTRY_OVERHEAD = 64
+
+
+def tile_range(
+    minx: float, miny: float, maxx: float, maxy: float, z: int
+) -> tuple[int, int, int, int]:
+    """
+    経緯度の範囲を、バッファも含めて描画しうるタイルの範囲（XYZ形式）に変換する
+    """
+    n = 2**z
+
+    def tile_x(lon: float) -> float:
+        return (lon + 180.0) / 360.0 * n
+
+    def tile_y(lat: float) -> float:
+        lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+        return (1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n
+
+    # タイルの端付近の地物は、隣のタイルのバッファにも描画される
+    x0 = math.floor(tile_x(minx) - TILE_BUFFER)
+    x1 = math.floor(tile_x(maxx) + TILE_BUFFER)
+    y0 = math.floor(tile_y(maxy) - TILE_BUFFER)
+    y1 = math.floor(tile_y(miny) + TILE_BUFFER)
+    return max(x0, 0), max(y0, 0), min(x1, n - 1), min(y1, n - 1)
+
+
+class TileCache:
+    """
+    PostGISで生成したタイルのキャッシュ
+
+    メモリ上のLRU（maxbytesまで）と、任意でディスク上のMBTiles（レイヤーごとに1ファイル）
+    の2段で保持する。
+    地物が変更されたら、変更前後の地物を含むタイルだけを全ズームレベルで破棄する。
+    """
+
+    def __init__(
+        self,
+        maxbytes: int = 256 * 1024 * 1024,
+        maxzoom: int = 22,
+        mbtiles_dir: Optional[str] = None,
+    ):
+        self.maxbytes = maxbytes
+        self.maxzoom = maxzoom
+        self.nbytes = 0
+        # 破棄のたびに増える値。タイルの生成中に破棄された場合は、生成したタイルを保存しない
+        self.version = 0
+        self._tiles: OrderedDict[tuple[str, int, int, int], bytes] = OrderedDict()
+        # (レイヤー名, ズームレベル) -> メモリ上にあるタイルの(x, y)。破棄するタイルを探すのに使う
+        self._index: dict[tuple[str, int], set[tuple[int, int]]] = {}
+        self._lock = threading.Lock()
+        self._mbtiles_dir = Path(mbtiles_dir) if mbtiles_dir else None
+        self._mbtiles: dict[str, sqlite3.Connection] = {}
+        # 変更通知のレイヤー名 -> 同じデータから生成している別のキャッシュのレイヤー名
+        self._dependents: dict[str, set[str]] = {}
+
+    def _disk(self, layer: str) -> Optional[sqlite3.Connection]:
+        if self._mbtiles_dir is None:
+            return None
+        conn = self._mbtiles.get(layer)
+        if conn is None:
+            self._mbtiles_dir.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(
+                self._mbtiles_dir / f"{layer}.mbtiles",
+                check_same_thread=False,
+                isolation_level=None,
+            )
+            # 複数のAPIワーカーから同じファイルを読み書きする
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA busy_timeout = 5000")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+                CREATE TABLE IF NOT EXISTS tiles (
+                    zoom_level INTEGER,
+                    tile_column INTEGER,
+                    tile_row INTEGER,
+                    tile_data BLOB
+                );
+                CREATE UNIQUE INDEX IF NOT EXISTS tile_index
+                    ON tiles (zoom_level, tile_column, tile_row);
+                """
+            )
+            self._mbtiles[layer] = conn
+        return conn
+
+    def get(self, layer: str, z: int, x: int, y: int) -> Optional[bytes]:
+        key = (layer, z, x, y)
+        with self._lock:
+            tile_data = self._tiles.get(key)
+            if tile_data is not None:
+                self._tiles.move_to_end(key)
+                return tile_data
+
+            disk = self._disk(layer)
+            if disk is None:
+                return None
+            row = disk.execute(
+                """SELECT tile_data FROM tiles
+                WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?""",
+                (z, x, 2**z - y - 1),
+            ).fetchone()
+            if row is None:
+                return None
+            # ディスクにあったタイルはメモリにも載せる
+            self._put_memory(key, row[0])
+            return row[0]
+
+    def put(
+        self, layer: str, z: int, x: int, y: int, tile_data: bytes, version: int
+    ):
+        """
+        タイルを保存する。versionには生成を始める前のself.versionを渡す
+        """
+        if z > self.maxzoom:
+            return
+        with self._lock:
+            if version != self.version:
+                # 生成中に地物が変更されたため、古い内容の可能性がある
+                return
+            disk = self._disk(layer)
+            if disk is not None:
+                disk.execute(
+                    "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                    (z, x, 2**z - y - 1, tile_data),
+                )
+            self._put_memory((layer, z, x, y), tile_data)
+
+    @staticmethod
+    def _entry_size(tile_data: bytes) -> int:
+        return len(tile_data) + TILE_ENTRY_OVERHEAD
+
+    def _put_memory(self, key: tuple[str, int, int, int], tile_data: bytes):
+        # self._lockを取得した状態で呼び出す
+        self._pop_memory(key)
+        layer, z, x, y = key
+        self._tiles[key] = tile_data
+        self._index.setdefault((layer, z), set()).add((x, y))
+        self.nbytes += self._entry_size(tile_data)
+        while self.nbytes > self.maxbytes:
+            self._pop_memory(next(iter(self._tiles)))
+
+    def _pop_memory(self, key: tuple[str, int, int, int]):
+        # self._lockを取得した状態で呼び出す
+        tile_data = self._tiles.pop(key, None)
+        if tile_data is None:
+            return
+        self.nbytes -= self._entry_size(tile_data)
+        layer, z, x, y = key
+        cached = self._index[(layer, z)]
+        cached.discard((x, y))
+        if not cached:
+            del self._index[(layer, z)]
+
+    def add_dependency(self, layer: str, source: str):
+        """
+        sourceのレイヤーが変更されたときに、layerのタイルも破棄するようにする
+        """
+        with self._lock:
+            self._dependents.setdefault(source, set()).add(layer)
+
+    def invalidate(
+        self, layer: str, minx: float, miny: float, maxx: float, maxy: float
+    ):
+        """
+        経緯度の範囲の地物を描画しうるタイルを、全ズームレベルで破棄する
+        """
+        ranges = {
+            z: tile_range(minx, miny, maxx, maxy, z) for z in range(self.maxzoom + 1)
+        }
+        with self._lock:
+            self.version += 1
+            layers = {layer} | self._dependents.get(layer, set())
+            for _layer in layers:
+                for z, (x0, y0, x1, y1) in ranges.items():
+                    cached = self._index.get((_layer, z))
+                    if not cached:
+                        continue
+                    # 範囲のタイルの数と、キャッシュにあるタイルの数の少ない方を調べる
+                    if (x1 - x0 + 1) * (y1 - y0 + 1) <= len(cached):
+                        xys = [
+                            (x, y)
+                            for x in range(x0, x1 + 1)
+                            for y in range(y0, y1 + 1)
+                            if (x, y) in cached
+                        ]
+                    else:
+                        xys = [
+                            (x, y)
+                            for x, y in cached
+                            if x0 <= x <= x1 and y0 <= y <= y1
+                        ]
+                    for x, y in xys:
+                        self._pop_memory((_layer, z, x, y))
+
+            for disk in map(self._disk, layers):
+                if disk is None:
+                    continue
+                for z, (x0, y0, x1, y1) in ranges.items():
+                    # tmsではy方向が反転する
+                    disk.execute(
+                        """DELETE FROM tiles WHERE zoom_level = ?
+                        AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?""",
+                        (z, x0, x1, 2**z - y1 - 1, 2**z - y0 - 1),
+                    )
+
+    def invalidate_point(self, layer: str, longitude: float, latitude: float):
+        self.invalidate(layer, longitude, latitude, longitude, latitude)
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._tiles.clear()
+            self._index.clear()
+            self.nbytes = 0
+            for conn in self._mbtiles.values():
+                conn.execute("DELETE FROM tiles")
+
+    def listen(self, dsn: str, channel: str = "tile_change"):
+        """
+        PostgreSQLのLISTEN/NOTIFYで地物の変更を受け取り、キャッシュを破棄するスレッドを開始する
+
+        他のAPIワーカーやSQLで直接行われた変更も、トリガーから通知される。
+        """
+        thread = threading.Thread(target=self._listen, args=(dsn, channel), daemon=True)
+        thread.start()
+        return thread
+
+    def _listen(self, dsn: str, channel: str):
+        conn = None
+        while True:
+            try:
+                conn = psycopg2.connect(dsn)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {channel}")
+                # 接続していなかった間の通知は受け取れないため、すべて破棄する
+                self.clear()
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        change = json.loads(notify.payload)
+                        for bbox in change["bboxes"]:
+                            self.invalidate(change["layer"], *bbox)
+            except Exception:
+                # 接続が切れたり、通知の内容が不正だったりしたら、少し待って接続し直す
+                # （スレッドが終わると、以降の変更でキャッシュが破棄されなくなる）
+                logger.exception("tile cache listener failed; reconnecting")
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                time.sleep(1)
@@ -0,0 +1,31 @@
+-- 地物が変更されたときに、変更前後の範囲をtile_changeチャンネルへ通知する
+-- APIはこの通知を受け取り、該当するタイルのキャッシュを破棄する
+CREATE OR REPLACE FUNCTION notify_tile_change() RETURNS trigger AS $$
+DECLARE
+  bboxes json[] := '{}';
+BEGIN
+  -- 一括登録では行ごとに通知せず、最後に全体の範囲をまとめて通知する
+  IF current_setting('app.bulk_import', true) = 'on' THEN
+    RETURN NULL;
+  END IF;
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    bboxes := bboxes || json_build_array(
+      ST_XMin(OLD.geom), ST_YMin(OLD.geom), ST_XMax(OLD.geom), ST_YMax(OLD.geom)
+    );
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    bboxes := bboxes || json_build_array(
+      ST_XMin(NEW.geom), ST_YMin(NEW.geom), ST_XMax(NEW.geom), ST_YMax(NEW.geom)
+    );
+  END IF;
+  PERFORM pg_notify(
+    'tile_change',
+    json_build_object('layer', TG_ARGV[0], 'bboxes', array_to_json(bboxes))::text
+  );
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER poi_tile_change
+  AFTER INSERT OR UPDATE OR DELETE ON poi
+  FOR EACH ROW EXECUTE FUNCTION notify_tile_change('poi');
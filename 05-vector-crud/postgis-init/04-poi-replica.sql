@@ -0,0 +1,24 @@
+-- 地物が変更されたときに、変更された地物のIDをpoi_changeチャンネルへ通知する
+-- APIのプロセス内の複製（app/replica.py）はこの通知を受け取り、該当する地物だけを読み直す
+CREATE OR REPLACE FUNCTION notify_poi_change() RETURNS trigger AS $$
+BEGIN
+  -- 一括登録では行ごとに通知せず、最後に全体の読み直しを通知する
+  IF current_setting('app.bulk_import', true) = 'on' THEN
+    RETURN NULL;
+  END IF;
+  PERFORM pg_notify(
+    'poi_change',
+    json_build_object(
+      'op', CASE WHEN TG_OP = 'DELETE' THEN 'delete' ELSE 'upsert' END,
+      'id', CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END,
+      -- 複製が反映までの遅れを計測するため、変更した時刻を含める
+      'ts', extract(epoch FROM clock_timestamp())
+    )::text
+  );
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER poi_replica_change
+  AFTER INSERT OR UPDATE OR DELETE ON poi
+  FOR EACH ROW EXECUTE FUNCTION notify_poi_change();
@@ -0,0 +1,91 @@
+-- 差分同期のため、地物の変更ごとにバージョン（全テーブルで共通の単調増加の値）を振る
+-- 削除した地物は{テーブル名}_tombstoneにIDとバージョンを残す
+-- APIのapp/changefeed.pyは、指定したバージョンより後の変更だけを返す
+CREATE SEQUENCE IF NOT EXISTS change_version_seq;
+
+-- バージョンはシーケンスから振るだけで、書き込みどうしを待たせない。
+-- そのため、先に振られたバージョンの変更が後からコミットされることがある。
+-- 読み込む側がその変更を読み飛ばさないよう、変更するトランザクションは最初にバージョンを振る前に、
+-- これから振るバージョン以下の値（シーケンスの現在値）で共有のアドバイザリロックを取り、コミットまで持つ。
+-- 共有ロックどうしは待たないため、一括登録を含めて書き込みは並行して進む。
+CREATE OR REPLACE FUNCTION next_change_version() RETURNS bigint AS $$
+BEGIN
+  IF current_setting('change_version.pending', true) IS DISTINCT FROM 'on' THEN
+    PERFORM pg_advisory_xact_lock_shared(
+      (SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM change_version_seq)
+    );
+    PERFORM set_config('change_version.pending', 'on', true);
+  END IF;
+  RETURN nextval('change_version_seq');
+END;
+$$ LANGUAGE plpgsql;
+
+-- 読み込んでよいバージョンの上限を返す。これ以下のバージョンの変更は、すべてコミット（またはロールバック）済み
+-- 変更を読み込むクエリは、この関数とは別の文で実行する（この関数の後に取られたスナップショットで読む）
+-- シーケンスの値を先に読み、その後でまだコミットされていないトランザクションのロックを探す
+-- （逆の順では、その間にロックを取ってバージョンを振ったトランザクションを見落とす）
+CREATE OR REPLACE FUNCTION change_version_watermark() RETURNS bigint AS $$
+DECLARE
+  assigned bigint;
+  pending bigint;
+BEGIN
+  SELECT CASE WHEN is_called THEN last_value ELSE 0 END INTO assigned FROM change_version_seq;
+  SELECT min((classid::bigint << 32) | objid::bigint) INTO pending
+  FROM pg_locks
+  WHERE locktype = 'advisory' AND objsubid = 1
+    AND database = (SELECT oid FROM pg_database WHERE datname = current_database());
+  -- leastはNULLを無視する
+  RETURN least(assigned, pending - 1);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION set_change_version() RETURNS trigger AS $$
+BEGIN
+  NEW.version := next_change_version();
+  IF TG_OP = 'INSERT' THEN
+    EXECUTE format('DELETE FROM %I WHERE id = $1', TG_TABLE_NAME || '_tombstone')
+      USING NEW.id;
+  END IF;
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION record_tombstone() RETURNS trigger AS $$
+BEGIN
+  EXECUTE format(
+    'INSERT INTO %I (id, version) VALUES ($1, $2)
+     ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version',
+    TG_TABLE_NAME || '_tombstone'
+  ) USING OLD.id, next_change_version();
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 行ごとではなく文ごとに、変更されたテーブルを通知する
+-- 同じトランザクション内の同じ内容の通知は1つにまとめられるため、一括登録でも通知は1回になる
+CREATE OR REPLACE FUNCTION notify_feature_change() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify('feature_change', json_build_object('layer', TG_TABLE_NAME)::text);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 既存の行にもバージョンを振る
+ALTER TABLE poi
+  ADD COLUMN IF NOT EXISTS version bigint NOT NULL DEFAULT nextval('change_version_seq');
+CREATE INDEX IF NOT EXISTS poi_version_idx ON poi (version);
+CREATE TABLE IF NOT EXISTS poi_tombstone (
+  id integer PRIMARY KEY,
+  version bigint NOT NULL
+);
+CREATE INDEX IF NOT EXISTS poi_tombstone_version_idx ON poi_tombstone (version);
+
+CREATE TRIGGER poi_change_version
+  BEFORE INSERT OR UPDATE ON poi
+  FOR EACH ROW EXECUTE FUNCTION set_change_version();
+CREATE TRIGGER poi_tombstone
+  AFTER DELETE ON poi
+  FOR EACH ROW EXECUTE FUNCTION record_tombstone();
+CREATE TRIGGER poi_change_notify
+  AFTER INSERT OR UPDATE OR DELETE ON poi
+  FOR EACH STATEMENT EXECUTE FUNCTION notify_feature_change();
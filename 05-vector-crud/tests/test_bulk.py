@@ -0,0 +1,50 @@
+import json
+
+from app.bulk import FeatureSplitter
+
+
+def feature(name: str) -> dict:
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [139.7, 35.6]},
+        "properties": {"name": name},
+    }
+
+
+def split(text: str, chunk_size: int) -> tuple[list[str], int]:
+    """
+    textをchunk_size文字ずつ渡して切り出した要素と、途中で保持したバッファの最大の長さを返す
+    """
+    splitter = FeatureSplitter()
+    items = []
+    max_buffer = 0
+    for i in range(0, len(text), chunk_size):
+        items += splitter.feed(text[i : i + chunk_size])
+        max_buffer = max(max_buffer, len(splitter._buffer))
+    return items, max_buffer
+
+
+def test_split_features():
+    features = [feature(f"poi{i}") for i in range(100)]
+    text = json.dumps({"type": "FeatureCollection", "features": features})
+    for chunk_size in (1, 7, 1000):
+        items, _ = split(text, chunk_size)
+        assert [json.loads(item) for item in items] == features
+
+
+def test_split_escaped_strings():
+    # json.dumpsは日本語を\uXXXXとしてエスケープする。引用符やバックスラッシュも含める
+    features = [feature('東京"駅\\'), feature("}{]["), feature("新宿")]
+    text = json.dumps({"type": "FeatureCollection", "features": features})
+    for chunk_size in (1, 2, 5, 1000):
+        items, _ = split(text, chunk_size)
+        assert [json.loads(item) for item in items] == features
+
+
+def test_buffer_stays_bounded_after_escape():
+    features = [feature("東京")] + [feature(f"poi{i}") for i in range(20000)]
+    text = json.dumps({"type": "FeatureCollection", "features": features})
+    items, max_buffer = split(text, 4096)
+    assert len(items) == len(features)
+    # 保持するのは受け取った1回分と、切り出し中の要素だけ
+    assert max_buffer < 4096 + 1000
@@ -1,11 +1,36 @@
-import asyncio
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Optional
 
-from fastapi import FastAPI, Response
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.staticfiles import StaticFiles
+from rio_tiler.colormap import cmap
 from rio_tiler.io import Reader
 from rio_tiler.profiles import img_profiles
 
-app = FastAPI()
+from render import DataFormat, TileRenderer, compile_expression
+from tilecache import RenderedTileCache
+
+# タイルを配信するCOG
+RGBNIR_COG_URL = "http://fileserver/rgbnir_cog.tif"
+B02_COG_URL = "https://sentinel-cogs.s3.us-west-2.amazonaws.com/sentinel-s2-l2a-cogs/54/T/WN/2023/11/S2B_54TWN_20231118_1_L2A/B02.tif"
+
+# スケーリングせずに返すタイルの形式ごとのMIMEタイプ
+DATA_MEDIA_TYPES = {"npy": "application/x-npy", "png": "image/png"}
+
+# タイル画像はワーカープロセスで生成する。プロセスは最初のタイルの生成時に起動する
+renderer = TileRenderer()
+# 生成したタイル画像のキャッシュ
+# TILE_CACHE_PATHを指定すると、メモリに加えてディスク上にも保存する
+tile_cache = RenderedTileCache()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    renderer.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/health")
@@ -32,6 +57,7 @@ async def make_image_cog(scale_min: float, scale_max: float):
 
 @app.get("/ndvi.png")
 async def make_image_ndvi():
+    # 画像全体を1枚で返す。地図のレイヤーには/tiles/expr/{z}/{x}/{y}.pngを使う
     with Reader("static/rgbnir_cog.tif") as image:
         imgdata = image.preview(expression="(b4-b1)/(b4+b1)")  # 2バンドを利用した計算式
         imgdata.rescale(((0, 1),))  # 0-1を0-255に変換
@@ -70,7 +96,37 @@ async def make_image_remote_cog_part(
     return Response(png, media_type="image/png")
 
 
-def get_tile(
+async def tile_response(
+    url: str,
+    z: int,
+    x: int,
+    y: int,
+    params: tuple,
+    render: Callable[[], Awaitable[Optional[bytes]]],
+    media_type: str = "image/png",
+    headers: Optional[dict[str, str]] = None,
+) -> Response:
+    """
+    タイルを返す。キャッシュになければrender()で生成する
+
+    キャッシュのキーはCOGのURL, z, x, yと、params（スケーリングなど、タイル画像を決める値）。
+    タイルがないという結果は、paramsによらずURL, z, x, yごとに保持する。
+    同じタイルへの同時のリクエストは、1回の生成の結果を共有する。
+    """
+    if z < 6 or not (0 <= x < 2**z and 0 <= y < 2**z):
+        # ズームレベル6未満と範囲外のタイルは生成しない（キャッシュもしない）
+        return Response(status_code=404)
+
+    data = await tile_cache.get_or_render(
+        (url, z, x, y, *params), render, missing_key=(url, z, x, y)
+    )
+    if data is None:
+        # タイルがない場合は404を返す
+        return Response(status_code=404)
+    return Response(data, media_type=media_type, headers=headers)
+
+
+async def image_tile(
     url: str,
     z: int,
     x: int,
@@ -78,17 +134,44 @@ def get_tile(
     indexes: tuple[int, ...] | None,
     scale_min: float,
     scale_max: float,
-):
+) -> Response:
     """
-    COGからデータを取得・タイル画像を生成する関数
+    COGのタイルの範囲をscale_min〜scale_maxで0〜255にスケーリングしたPNG画像を返す
     """
-    with Reader(url) as image:
-        if not image.tile_exists(x, y, z):
-            return None
-        imgdata = image.tile(x, y, z, indexes=indexes, resampling_method="bilinear")
-        imgdata.rescale(((scale_min, scale_max),))
-        png = imgdata.render(img_format="PNG", **img_profiles.get("png"))
-        return png
+    return await tile_response(
+        url,
+        z,
+        x,
+        y,
+        (indexes, scale_min, scale_max),
+        lambda: renderer.render(url, z, x, y, indexes, scale_min, scale_max),
+    )
+
+
+async def data_tile(
+    url: str,
+    z: int,
+    x: int,
+    y: int,
+    indexes: tuple[int, ...] | None,
+    format: DataFormat,
+) -> Response:
+    """
+    COGのタイルの範囲の値を、スケーリングせずに返す
+
+    スケーリングの範囲によらないため、キャッシュもスケーリングの範囲ごとには持たない。
+    クライアントが範囲を変えながら描画しても、同じタイルはブラウザのキャッシュから読む。
+    """
+    return await tile_response(
+        url,
+        z,
+        x,
+        y,
+        (indexes, format),
+        lambda: renderer.render_data(url, z, x, y, indexes, format),
+        media_type=DATA_MEDIA_TYPES[format],
+        headers={"Cache-Control": "public, max-age=86400"},
+    )
 
 
 @app.get("/tiles/{z}/{x}/{y}.png")
@@ -99,15 +182,8 @@ async def make_image_remote_cog_tile(
     scale_min: float = 0,
     scale_max: float = 2000,
 ):
-    if z < 6:
-        # ズームレベル6以下は404を返す
-        return Response(status_code=404)
-
-    loop = asyncio.get_event_loop()
-    png = await loop.run_in_executor(
-        None,
-        get_tile,
-        "http://fileserver/rgbnir_cog.tif",
+    return await image_tile(
+        RGBNIR_COG_URL,
         z,
         x,
         y,
@@ -116,8 +192,6 @@ async def make_image_remote_cog_tile(
         scale_max,
     )
 
-    return Response(png, media_type="image/png")
-
 
 @app.get("/tiles/B02/{z}/{x}/{y}.png")
 async def make_image_remote_b02_tile(
@@ -127,15 +201,8 @@ async def make_image_remote_b02_tile(
     scale_min: float = 0,
     scale_max: float = 2000,
 ):
-    if z < 6:
-        # ズームレベル6以下は404を返す
-        return Response(status_code=404)
-
-    loop = asyncio.get_event_loop()
-    png = await loop.run_in_executor(
-        None,
-        get_tile,
-        "https://sentinel-cogs.s3.us-west-2.amazonaws.com/sentinel-s2-l2a-cogs/54/T/WN/2023/11/S2B_54TWN_20231118_1_L2A/B02.tif",
+    return await image_tile(
+        B02_COG_URL,
         z,
         x,
         y,
@@ -144,7 +211,64 @@ async def make_image_remote_b02_tile(
         scale_max,
     )
 
-    return Response(png, media_type="image/png")
+
+@app.get("/tiles/data/{z}/{x}/{y}.{format}")
+async def make_remote_cog_data_tile(z: int, x: int, y: int, format: DataFormat):
+    """
+    タイルの範囲のバンド1〜3の値を、スケーリングせずに返す（クライアントでスケーリングする）
+    """
+    return await data_tile(RGBNIR_COG_URL, z, x, y, (1, 2, 3), format)
+
+
+@app.get("/tiles/B02/data/{z}/{x}/{y}.{format}")
+async def make_remote_b02_data_tile(z: int, x: int, y: int, format: DataFormat):
+    """
+    タイルの範囲のB02の値を、スケーリングせずに返す（クライアントでスケーリングする）
+    """
+    return await data_tile(B02_COG_URL, z, x, y, None, format)
+
+
+@app.get("/tiles/expr/{z}/{x}/{y}.png")
+async def make_remote_cog_expression_tile(
+    z: int,
+    x: int,
+    y: int,
+    expression: str = "(b4-b1)/(b4+b1)",
+    rescale_min: float = -1,
+    rescale_max: float = 1,
+    colormap: Optional[str] = "rdylgn",
+):
+    """
+    バンドの計算式（既定はNDVI）の値をrescale_min〜rescale_maxでスケーリングし、
+    colormapで着色したタイル画像を返す
+
+    式が参照するバンドだけを読むため、NDVIのタイルはRGBのタイルと同程度のコストで生成できる。
+    """
+    if colormap is not None and colormap not in cmap.list():
+        raise HTTPException(status_code=400, detail=f"不明なカラーマップです: {colormap}")
+    try:
+        compiled = compile_expression(expression)
+        await renderer.check_bands(RGBNIR_COG_URL, compiled.bands)
+        return await tile_response(
+            RGBNIR_COG_URL,
+            z,
+            x,
+            y,
+            (expression, rescale_min, rescale_max, colormap),
+            lambda: renderer.render_expression(
+                RGBNIR_COG_URL,
+                z,
+                x,
+                y,
+                expression,
+                rescale_min,
+                rescale_max,
+                colormap,
+            ),
+        )
+    except (ValueError, IndexError) as e:
+        # 式の誤り（タイルの生成中に分かった、計算できない式なども含む）
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 app.mount("/", StaticFiles(directory="static"), name="static")
@@ -0,0 +1,387 @@
+import ast
+import asyncio
+import functools
+import multiprocessing
+import os
+import re
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from types import CodeType
+from typing import Callable, Literal, NamedTuple, Optional
+
+import numpy as np
+from rio_tiler.colormap import cmap
+from rio_tiler.io import Reader
+from rio_tiler.models import ImageData
+from rio_tiler.profiles import img_profiles
+
+# タイルを生成するワーカープロセス数（既定はCPU数）
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", "0")) or os.cpu_count() or 1
+# ワーカーごとに開いたままにしておくCOGの数
+DATASET_CACHE_SIZE = int(os.environ.get("DATASET_CACHE_SIZE", "8"))
+# 隣り合う2**AFFINITY_SHIFT四方のタイルは同じワーカーで生成する
+# COGの同じブロックを読むことが多く、ワーカーのブロックキャッシュが効く
+AFFINITY_SHIFT = 2
+
+# スケーリングせずに返すタイルの形式
+# npy: バンドの値とマスク（最後のバンド、0または255）を重ねたNumPyの配列（.npy）
+# png: 16bitのPNG（マスクはアルファチャンネル）。値がuint8かuint16のCOGのみ
+DataFormat = Literal["npy", "png"]
+
+# バンドの計算式で使える関数。numpy.maの関数で、マスクを保ったまま計算する
+EXPRESSION_FUNCTIONS = {
+    name: getattr(np.ma, name)
+    for name in ("abs", "sqrt", "log", "log10", "exp", "minimum", "maximum", "where")
+}
+# バンドの計算式で使える構文
+EXPRESSION_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Compare,
+    ast.Call,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.Pow,
+    ast.USub,
+    ast.UAdd,
+    ast.Gt,
+    ast.GtE,
+    ast.Lt,
+    ast.LtE,
+)
+BAND_NAME = re.compile(r"b([1-9][0-9]*)")
+
+# ワーカーのGDALの設定。環境変数で指定されていればそちらを優先する
+GDAL_OPTIONS = {
+    # 読み込んだブロックのキャッシュ（MB）
+    "GDAL_CACHEMAX": "256",
+    # リモートのファイルから読み込んだ範囲のキャッシュ（ファイルごと、バイト）
+    "VSI_CACHE": "TRUE",
+    "VSI_CACHE_SIZE": str(64 * 1024 * 1024),
+    # 開くときに、リモートのディレクトリの一覧（.ovrなど）を取得しない
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    # 連続する範囲の読み込みを1回のHTTPリクエストにまとめる
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "GDAL_HTTP_VERSION": "2",
+}
+
+# ワーカープロセスごとの、URL -> 開いたままのReader（最近使った順）
+_datasets: "OrderedDict[str, Reader]" = OrderedDict()
+
+
+def init_worker():
+    for key, value in GDAL_OPTIONS.items():
+        os.environ.setdefault(key, value)
+
+
+def open_dataset(url: str) -> Reader:
+    """
+    URLのCOGを開いたReaderを返す。開いたReaderは使い回し、ヘッダーを読み直さない
+    """
+    reader = _datasets.get(url)
+    if reader is not None:
+        _datasets.move_to_end(url)
+        return reader
+    reader = _datasets[url] = Reader(url)
+    if len(_datasets) > DATASET_CACHE_SIZE:
+        _, oldest = _datasets.popitem(last=False)
+        oldest.close()
+    return reader
+
+
+def close_dataset(url: str):
+    reader = _datasets.pop(url, None)
+    if reader is not None:
+        reader.close()
+
+
+def read_tile(
+    url: str, z: int, x: int, y: int, indexes: Optional[tuple[int, ...]]
+) -> Optional[ImageData]:
+    image = open_dataset(url)
+    try:
+        if not image.tile_exists(x, y, z):
+            return None
+        return image.tile(x, y, z, indexes=indexes, resampling_method="bilinear")
+    except Exception:
+        # 接続が切れたなど、開いたままのReaderが使えなくなった場合に備えて開き直させる
+        close_dataset(url)
+        raise
+
+
+class BandExpression(NamedTuple):
+    code: CodeType
+    # 式が参照するバンド（昇順）
+    bands: tuple[int, ...]
+
+
+@functools.lru_cache(maxsize=256)
+def compile_expression(expression: str) -> BandExpression:
+    """
+    バンドの計算式（例: (b4-b1)/(b4+b1)）を検証してコンパイルする。不正な式はValueError
+
+    使えるのはバンド（b1, b2, ...）、数値、四則演算と**、比較、EXPRESSION_FUNCTIONSの関数。
+    同じ式はコンパイルし直さない。
+    """
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"式を解釈できません: {e.msg}")
+    bands = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, EXPRESSION_NODES):
+            raise ValueError(f"式に使えない構文です: {type(node).__name__}")
+        if isinstance(node, ast.Name):
+            match = BAND_NAME.fullmatch(node.id)
+            if match:
+                bands.add(int(match.group(1)))
+            elif node.id not in EXPRESSION_FUNCTIONS:
+                raise ValueError(f"不明な名前です: {node.id}")
+        elif isinstance(node, ast.Compare):
+            # a < b < cは配列どうしでは計算できない（真偽値が1つに決まらない）
+            if len(node.ops) > 1:
+                raise ValueError("比較は1つずつ行ってください（例: (b1 < b2) * (b2 < b3)）")
+        elif isinstance(node, ast.Call):
+            if (
+                not isinstance(node.func, ast.Name)
+                or node.func.id not in EXPRESSION_FUNCTIONS
+                or node.keywords
+            ):
+                raise ValueError("関数はEXPRESSION_FUNCTIONSの関数のみ使えます")
+        elif isinstance(node, ast.Constant):
+            if not isinstance(node.value, (int, float)) or isinstance(
+                node.value, bool
+            ):
+                raise ValueError(f"式に使えない値です: {node.value!r}")
+            # 整数どうしのべき乗で、巨大な整数を計算させない
+            node.value = float(node.value)
+    if not bands:
+        raise ValueError("式にバンド（b1, b2, ...）が含まれていません")
+    return BandExpression(compile(tree, "<expression>", "eval"), tuple(sorted(bands)))
+
+
+def evaluate_expression(
+    expression: BandExpression, data: np.ma.MaskedArray
+) -> np.ma.MaskedArray:
+    """
+    dataはexpression.bandsの順に読み込んだバンドの値（バンド, 高さ, 幅）
+
+    画素ごとに繰り返さず、タイル全体を配列のまま計算する。
+    0での割り算などで値が求まらない画素はマスクする。
+    """
+    namespace = {
+        f"b{band}": data[i].astype("float32")
+        for i, band in enumerate(expression.bands)
+    }
+    with np.errstate(all="ignore"):
+        try:
+            result = eval(
+                expression.code,
+                {"__builtins__": {}, **EXPRESSION_FUNCTIONS},
+                namespace,
+            )
+        except (ArithmeticError, ValueError) as e:
+            raise ValueError(f"式を計算できません: {e}")
+    return np.ma.masked_invalid(np.ma.asarray(result, dtype="float32"))
+
+
+def band_count(url: str) -> int:
+    return open_dataset(url).dataset.count
+
+
+def check_bands(bands: tuple[int, ...], count: int):
+    """
+    バンド数countのCOGにないバンドが含まれていればValueError
+    """
+    missing = [band for band in bands if band > count]
+    if missing:
+        names = ", ".join(f"b{band}" for band in missing)
+        raise ValueError(f"COGにないバンドです: {names}（バンド数は{count}）")
+
+
+def render_tile(
+    url: str,
+    z: int,
+    x: int,
+    y: int,
+    indexes: Optional[tuple[int, ...]],
+    scale_min: float,
+    scale_max: float,
+) -> Optional[bytes]:
+    """
+    COGからデータを取得・タイル画像を生成する関数（ワーカープロセスで実行する）
+    """
+    imgdata = read_tile(url, z, x, y, indexes)
+    if imgdata is None:
+        return None
+    imgdata.rescale(((scale_min, scale_max),))
+    return imgdata.render(img_format="PNG", **img_profiles.get("png"))
+
+
+def render_data_tile(
+    url: str,
+    z: int,
+    x: int,
+    y: int,
+    indexes: Optional[tuple[int, ...]],
+    format: DataFormat,
+) -> Optional[bytes]:
+    """
+    COGのタイルの範囲の値を、スケーリングせずに返す（ワーカープロセスで実行する）
+
+    スケーリング（ストレッチ）はクライアントで行うため、
+    範囲を変えてもサーバーでの処理は不要になる。
+    """
+    imgdata = read_tile(url, z, x, y, indexes)
+    if imgdata is None:
+        return None
+    if format == "png":
+        return imgdata.render(img_format="PNG", **img_profiles.get("png"))
+    return imgdata.render(img_format="NPY")
+
+
+def render_expression_tile(
+    url: str,
+    z: int,
+    x: int,
+    y: int,
+    expression: str,
+    rescale_min: float,
+    rescale_max: float,
+    colormap: Optional[str],
+) -> Optional[bytes]:
+    """
+    バンドの計算式の値のタイル画像を生成する（ワーカープロセスで実行する）
+
+    式が参照するバンドだけを、タイルのズームレベルに合ったオーバービューから読む。
+    値はrescale_min〜rescale_maxで0〜255にスケーリングし、colormapで着色する。
+    """
+    compiled = compile_expression(expression)
+    check_bands(compiled.bands, band_count(url))
+    imgdata = read_tile(url, z, x, y, compiled.bands)
+    if imgdata is None:
+        return None
+    result = evaluate_expression(compiled, imgdata.array)
+    image = ImageData(result[np.newaxis], bounds=imgdata.bounds, crs=imgdata.crs)
+    image.rescale(((rescale_min, rescale_max),))
+    return image.render(
+        img_format="PNG",
+        colormap=cmap.get(colormap) if colormap else None,
+        **img_profiles.get("png"),
+    )
+
+
+class TileRenderer:
+    """
+    ワーカープロセスでタイル画像を生成する
+
+    デコード・リサンプリング・PNGへのエンコードはGILを解放しない処理が多く、
+    スレッドでは並列にならないため、プロセスに分ける。
+    タイルはURLと位置から決まるワーカーに割り当て、
+    ワーカーが開いたままのCOGと読み込んだブロックのキャッシュを使い回せるようにする。
+    """
+
+    def __init__(self, workers: int = RENDER_WORKERS):
+        # GDALのスレッドを持ったままforkしないよう、spawnでプロセスを起動する
+        self._context = multiprocessing.get_context("spawn")
+        # URL -> COGのバンド数
+        self._band_counts: dict[str, int] = {}
+        # 割り当て先を選べるよう、ワーカーごとに1プロセスのプールを作る
+        self._executors = [self._new_executor() for _ in range(workers)]
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(1, mp_context=self._context, initializer=init_worker)
+
+    def worker_for(self, url: str, z: int, x: int, y: int) -> int:
+        key = f"{url}/{z}/{x >> AFFINITY_SHIFT}/{y >> AFFINITY_SHIFT}"
+        return zlib.crc32(key.encode()) % len(self._executors)
+
+    async def _call(self, worker: int, fn: Callable, *args):
+        loop = asyncio.get_running_loop()
+        executor = self._executors[worker]
+        try:
+            return await loop.run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            # ワーカーが異常終了した（GDALでのメモリ不足など）。プールを作り直して1回だけやり直す
+            # 同時に失敗した他のリクエストが作り直していれば、そのプールを使う
+            if self._executors[worker] is executor:
+                executor.shutdown(wait=False)
+                self._executors[worker] = self._new_executor()
+            return await loop.run_in_executor(self._executors[worker], fn, *args)
+
+    async def run(self, fn: Callable, url: str, z: int, x: int, y: int, *args):
+        """
+        fn(url, z, x, y, *args)を、タイルを割り当てたワーカーで実行する
+        """
+        return await self._call(self.worker_for(url, z, x, y), fn, url, z, x, y, *args)
+
+    async def check_bands(self, url: str, bands: tuple[int, ...]):
+        """
+        COGにないバンドが含まれていればValueError。バンド数はURLごとに1回だけ調べる
+        """
+        if url not in self._band_counts:
+            self._band_counts[url] = await self._call(
+                self.worker_for(url, 0, 0, 0), band_count, url
+            )
+        check_bands(bands, self._band_counts[url])
+
+    async def render(
+        self,
+        url: str,
+        z: int,
+        x: int,
+        y: int,
+        indexes: Optional[tuple[int, ...]],
+        scale_min: float,
+        scale_max: float,
+    ) -> Optional[bytes]:
+        return await self.run(
+            render_tile, url, z, x, y, indexes, scale_min, scale_max
+        )
+
+    async def render_data(
+        self,
+        url: str,
+        z: int,
+        x: int,
+        y: int,
+        indexes: Optional[tuple[int, ...]],
+        format: DataFormat,
+    ) -> Optional[bytes]:
+        return await self.run(render_data_tile, url, z, x, y, indexes, format)
+
+    async def render_expression(
+        self,
+        url: str,
+        z: int,
+        x: int,
+        y: int,
+        expression: str,
+        rescale_min: float,
+        rescale_max: float,
+        colormap: Optional[str],
+    ) -> Optional[bytes]:
+        return await self.run(
+            render_expression_tile,
+            url,
+            z,
+            x,
+            y,
+            expression,
+            rescale_min,
+            rescale_max,
+            colormap,
+        )
+
+    def close(self):
+        for executor in self._executors:
+            executor.shutdown(cancel_futures=True)
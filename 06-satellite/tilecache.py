@@ -0,0 +1,166 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Hashable, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+# メモリ上に保持するタイル画像の合計サイズ（バイト）
+TILE_CACHE_MAXBYTES = int(os.environ.get("TILE_CACHE_MAXBYTES", 256 * 1024 * 1024))
+# ディスク上のキャッシュのファイル。未指定ならメモリ上にだけ保持する
+TILE_CACHE_PATH = os.environ.get("TILE_CACHE_PATH")
+
+# タイルがない（範囲外）ことを表す値。キャッシュにないこと（None）と区別する
+NO_TILE = b""
+# キャッシュの1件ごとに、タイル画像のサイズに加えて数えるサイズ（キーや辞書の分）
+# サイズ0のNO_TILEも上限の対象にし、件数が際限なく増えないようにする
+TILE_ENTRY_OVERHEAD = 256
+
+
+class RenderedTileCache:
+    """
+    COGから生成したタイル画像のキャッシュ
+
+    キーは（COGのURL, z, x, y, バンド, scale_min, scale_max）などの、タイル画像を決める値の組。
+    メモリ上のLRU（maxbytesまで）と、任意でディスク上のSQLiteファイルの2段で保持する。
+    タイルがないという結果は、スケーリングなどによらないタイルの位置のキーにNO_TILEとして保持する。
+    ディスクの読み書きはスレッドプールで行い、イベントループを止めない。
+    SQLiteのコネクションはスレッドごとに作り、メモリ上のLRUのロックを持たずに読み書きする。
+    """
+
+    def __init__(
+        self,
+        maxbytes: int = TILE_CACHE_MAXBYTES,
+        path: Optional[str] = TILE_CACHE_PATH,
+    ):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self._tiles: OrderedDict[Hashable, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+        self._path = path
+        # スレッドごとのSQLiteのコネクション
+        self._local = threading.local()
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            # 複数のAPIワーカーやスレッドから同じファイルを読み書きする
+            conn = self._connect()
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tiles (key TEXT PRIMARY KEY, tile_data BLOB)"
+            )
+        # 生成中のタイルのキー -> 生成しているタスク
+        self._rendering: dict[Hashable, asyncio.Task] = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout = 5000")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _disk_key(key: Hashable) -> str:
+        return json.dumps(key)
+
+    def _get_memory(self, key: Hashable) -> Optional[bytes]:
+        with self._lock:
+            tile_data = self._tiles.get(key)
+            if tile_data is not None:
+                self._tiles.move_to_end(key)
+            return tile_data
+
+    def _get_disk(self, key: Hashable) -> Optional[bytes]:
+        # スレッドプールで実行する
+        row = (
+            self._connect()
+            .execute(
+                "SELECT tile_data FROM tiles WHERE key = ?", (self._disk_key(key),)
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        # ディスクにあったタイルはメモリにも載せる
+        with self._lock:
+            self._put_memory(key, row[0])
+        return row[0]
+
+    async def get(self, key: Hashable) -> Optional[bytes]:
+        tile_data = self._get_memory(key)
+        if tile_data is None and self._path:
+            tile_data = await run_in_threadpool(self._get_disk, key)
+        return tile_data
+
+    def _put_disk(self, key: Hashable, tile_data: bytes):
+        # スレッドプールで実行する
+        self._connect().execute(
+            "INSERT OR REPLACE INTO tiles VALUES (?, ?)",
+            (self._disk_key(key), tile_data),
+        )
+
+    async def put(self, key: Hashable, tile_data: bytes):
+        with self._lock:
+            self._put_memory(key, tile_data)
+        if self._path:
+            await run_in_threadpool(self._put_disk, key, tile_data)
+
+    @staticmethod
+    def _entry_size(tile_data: bytes) -> int:
+        return len(tile_data) + TILE_ENTRY_OVERHEAD
+
+    def _put_memory(self, key: Hashable, tile_data: bytes):
+        # self._lockを取得した状態で呼び出す
+        if key in self._tiles:
+            self.nbytes -= self._entry_size(self._tiles.pop(key))
+        self._tiles[key] = tile_data
+        self.nbytes += self._entry_size(tile_data)
+        while self.nbytes > self.maxbytes:
+            _, evicted = self._tiles.popitem(last=False)
+            self.nbytes -= self._entry_size(evicted)
+
+    async def get_or_render(
+        self,
+        key: Hashable,
+        render: Callable[[], Awaitable[Optional[bytes]]],
+        missing_key: Optional[Hashable] = None,
+    ) -> Optional[bytes]:
+        """
+        キャッシュにあればそれを、なければrender()で生成して保存したタイル画像を返す
+
+        render()がNoneを返した場合（タイルがない場合）は、missing_key（タイルの位置など、
+        タイルの有無を決める値の組。省略時はkey）にNO_TILEを保存し、Noneを返す。
+        同じキーの生成が同時に要求された場合は1回だけ生成し、結果を共有する。
+        生成は要求とは別のタスクで行うため、最初に要求したクライアントが切断しても続く。
+        """
+        missing_key = key if missing_key is None else missing_key
+        tile_data = await self.get(key)
+        if tile_data is None and missing_key != key:
+            tile_data = await self.get(missing_key)
+            if tile_data != NO_TILE:
+                tile_data = None
+        if tile_data is None:
+            task = self._rendering.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self._render(key, render, missing_key))
+                self._rendering[key] = task
+                task.add_done_callback(lambda _: self._rendering.pop(key, None))
+            tile_data = await asyncio.shield(task)
+        return tile_data if tile_data != NO_TILE else None
+
+    async def _render(
+        self,
+        key: Hashable,
+        render: Callable[[], Awaitable[Optional[bytes]]],
+        missing_key: Hashable,
+    ) -> bytes:
+        tile_data = await render()
+        if tile_data is None:
+            await self.put(missing_key, NO_TILE)
+            return NO_TILE
+        await self.put(key, tile_data)
+        return tile_data
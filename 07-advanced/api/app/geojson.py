@@ -0,0 +1,107 @@
+import json
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator, Literal, Optional
+
+import anyio
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.types import Receive, Scope, Send
+
+from app.db import STREAM_FETCH_SIZE
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# geojson: GeoJSON-FeatureCollection
+# geojsonseq: 1行に1つのGeoJSON-Featureを並べた形式（GeoJSONSeq）
+GeoJSONFormat = Literal["geojson", "geojsonseq"]
+
+
+def dumps(obj: Any) -> str:
+    """
+    JSONの文字列に変換する。orjsonがインストールされていれば使う
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    orjsonがインストールされていれば、orjsonでシリアライズするJSONレスポンス
+
+    標準のjsonモジュールより高速で、地物の多いレスポンスで差が大きい。
+    """
+
+    def render(self, content: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content)
+        return super().render(content)
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    送信を終えたとき（クライアントが切断した場合も）に、close()をスレッドプールで呼ぶStreamingResponse
+
+    コネクションを占有するイテレーター（ConnectionPool.stream）を、GCを待たずに閉じるために使う。
+    """
+
+    def __init__(self, content: Iterable[str], close: Callable[[], None], **kwargs):
+        super().__init__(content, **kwargs)
+        self.close = close
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # 切断によるキャンセル中でも、閉じ終わるまで待つ
+            with anyio.CancelScope(shield=True):
+                await run_in_threadpool(self.close)
+
+
+def batched(iterable: Iterable, n: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, n)):
+        yield batch
+
+
+def feature_collection(features: Iterable[str]) -> Iterator[str]:
+    """
+    GeoJSON-Featureの文字列から、FeatureCollectionを少しずつ組み立てる
+    """
+    yield '{"type":"FeatureCollection","features":['
+    separator = ""
+    # 1つずつ返すとスレッドの切り替えが増えるため、まとめて返す
+    for batch in batched(features, STREAM_FETCH_SIZE):
+        yield separator + ",".join(batch)
+        separator = ","
+    yield "]}"
+
+
+def feature_sequence(features: Iterable[str]) -> Iterator[str]:
+    for batch in batched(features, STREAM_FETCH_SIZE):
+        yield "".join(f"{feature}\n" for feature in batch)
+
+
+def geojson_response(
+    features: Iterable[str],
+    format: GeoJSONFormat = "geojson",
+    close: Optional[Callable[[], None]] = None,
+) -> StreamingResponse:
+    """
+    GeoJSON-Featureの文字列を、すべて揃うのを待たずに順にレスポンスする
+
+    closeには、featuresの元になったイテレーターを閉じる関数を渡す。
+    送信を終えたとき、またはクライアントが切断したときに呼ぶ。
+    """
+    if format == "geojsonseq":
+        content = feature_sequence(features)
+        media_type = "application/geo+json-seq"
+    else:
+        content = feature_collection(features)
+        media_type = "application/geo+json"
+    if close is None:
+        return StreamingResponse(content, media_type=media_type)
+    return ClosingStreamingResponse(content, close, media_type=media_type)
@@ -1,6 +1,8 @@
 from typing import Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+from app.nearby import MAX_BATCH_NEAREST, MAX_BATCH_POINTS, MAX_RADIUS
 
 
 class PointCreate(BaseModel):
@@ -11,3 +13,13 @@ class PointCreate(BaseModel):
 class PointUpdate(BaseModel):
     longitude: Optional[float] = None
     latitude: Optional[float] = None
+
+
+class NearestBatch(BaseModel):
+    # 問い合わせる点の[経度, 緯度]の配列
+    points: list[tuple[float, float]] = Field(
+        min_length=1, max_length=MAX_BATCH_POINTS
+    )
+    k: int = Field(10, ge=1, le=MAX_BATCH_NEAREST)
+    # 距離の上限（メートル）
+    radius: Optional[float] = Field(None, gt=0, le=MAX_RADIUS)
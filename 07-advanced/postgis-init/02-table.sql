@@ -1,4 +1,7 @@
 CREATE TABLE IF NOT EXISTS points (
   id SERIAL PRIMARY KEY,
   geom GEOMETRY(POINT, 4326)
-);
\ No newline at end of file
+);
+
+-- 近傍検索（<->）や距離での絞り込みで使う
+CREATE INDEX IF NOT EXISTS points_geom_idx ON points USING GIST (geom);
@@ -36,7 +36,32 @@ const loadPoints = async (): Promise<PointsResponse> => {
     return data;
 };
 
+type PointChanges = {
+    type: 'FeatureCollection';
+    version: number;
+    hasMore: boolean;
+    features: PointsResponse['features'];
+    deleted: string[];
+};
+
+const subscribePoints = (onChange: (changes: PointChanges) => void) => {
+    // since=0で既存の地点をすべて受け取り、以降は変更された地点だけを受け取る
+    // 切断されても、EventSourceが最後に受け取ったバージョン（Last-Event-ID）から再開する
+    const source = new EventSource(`${API_HOST}/points/changes/stream?since=0`);
+    source.addEventListener('change', (event) => {
+        onChange(JSON.parse((event as MessageEvent).data));
+    });
+    return source;
+};
+
 const satelliteImageUrl = (id: string, maxSize: number = 256) =>
     `${API_HOST}/points/${id}/satellite.jpg?max_size=${maxSize}`;
 
-export { createPoint, deletePoint, loadPoints, satelliteImageUrl };
+export {
+    createPoint,
+    deletePoint,
+    loadPoints,
+    subscribePoints,
+    satelliteImageUrl,
+};
+export type { PointChanges };
@@ -1,7 +1,13 @@
 import 'maplibre-gl/dist/maplibre-gl.css';
 import { Map, Marker, Popup } from 'maplibre-gl';
 
-import { createPoint, loadPoints, deletePoint, satelliteImageUrl } from './api';
+import {
+    createPoint,
+    deletePoint,
+    subscribePoints,
+    satelliteImageUrl,
+} from './api';
+import type { PointChanges } from './api';
 
 const map = new Map({
     container: 'app',
@@ -29,7 +35,8 @@ const map = new Map({
 });
 
 // Marker関連の処理
-const markers: Marker[] = [];
+// 地点のIDごとのMarker
+const markers: { [id: string]: Marker } = {};
 let isMarkerClicked = false;
 
 const createPopupDom = (id: string) => {
@@ -57,9 +64,8 @@ const createPopupDom = (id: string) => {
     buttonDom.textContent = '削除';
     buttonDom.onclick = async () => {
         if (!confirm('地点を削除しますか？')) return;
+        // 削除した地点は、変更の通知を受け取ってから地図から除く
         await deletePoint(id);
-        clearMarkers();
-        await loadMarkers();
     };
 
     popupDom.appendChild(anchor);
@@ -67,9 +73,18 @@ const createPopupDom = (id: string) => {
     return popupDom;
 };
 
-const loadMarkers = async () => {
-    const points = await loadPoints();
-    points.features.forEach((feature) => {
+const removeMarker = (id: string) => {
+    markers[id]?.remove();
+    delete markers[id];
+};
+
+const applyChanges = (changes: PointChanges) => {
+    // 全件を読み込み直さず、変更された地点だけを反映する
+    changes.deleted.forEach((id) => removeMarker(String(id)));
+    changes.features.forEach((feature) => {
+        const id = String(feature.properties.id);
+        // 更新された地点は作り直す
+        removeMarker(id);
         const popup = new Popup().setMaxWidth('500px');
         const marker = new Marker()
             .setLngLat(feature.geometry.coordinates)
@@ -78,18 +93,14 @@ const loadMarkers = async () => {
         marker.getElement().addEventListener('click', () => {
             isMarkerClicked = true;
             // ピンのクリック時に画像を読み込ませたいので、DOMを作成するタイミングをマーカーのクリック時にする
-            popup.setDOMContent(createPopupDom(feature.properties.id));
+            popup.setDOMContent(createPopupDom(id));
         });
-        markers.push(marker);
+        markers[id] = marker;
     });
 };
 
-const clearMarkers = () => {
-    markers.forEach((marker) => marker.remove());
-};
-
-map.on('load', async () => {
-    await loadMarkers();
+map.on('load', () => {
+    subscribePoints(applyChanges);
 });
 
 map.on('click', async (e) => {
@@ -102,7 +113,6 @@ map.on('click', async (e) => {
     if (!confirm('地点を作成しますか？')) return;
 
     const { lng, lat } = e.lngLat;
+    // 作成した地点は、変更の通知を受け取って地図に追加する
     await createPoint({ longitude: lng, latitude: lat });
-    clearMarkers();
-    await loadMarkers();
 });